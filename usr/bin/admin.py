@@ -9,8 +9,14 @@ import pylon.gentoo.ui
 import re
 import shlex
 import sys
+import tempfile
 import time
 
+cache_dir = '/var/cache/admin'
+emerge_log = '/var/log/emerge.log'
+emerge_mtimedb = '/var/cache/edb/mtimedb'
+emerge_log_regex = re.compile(r'^(\d+):\s+(>>> emerge|::: completed emerge) \(\d+ of \d+\) (\S+) to ')
+
 class ui(pylon.gentoo.ui.ui):
     def __init__(self, owner):
         super().__init__(owner)
@@ -20,7 +26,10 @@ class ui(pylon.gentoo.ui.ui):
         self.init_op_parser()
         self.parser_check_repos.add_argument('-l', '--list_files', action='store_true')
         self.parser_check_repos.add_argument('-r', '--rebase', action='store_true')
-        self.parser_kernel.add_argument('-s', '--small', action='store_true', help='skip rsync of large ISOs')
+        self.parser_check_repos.add_argument('-c', '--local_clone', action='store_true', help='prepare temporary master repo from local objects')
+        self.parser_kernel.add_argument('-s', '--small', action='store_true', help='skip sync of large ISOs')
+        self.parser_spindown.add_argument('-d', '--daemon', action='store_true', help='stay resident and spin down whenever idle')
+        self.parser_spindown.add_argument('-w', '--window', type=int, default=5, help='idle window in minutes')
         self.parser_update.add_argument('-s', '--sync', action='store_true')
         self.parser_wrap.add_argument('-s', '--sync', action='store_true', help='sync to device')
 
@@ -45,7 +54,281 @@ class admin(pylon.base.base):
             [files.remove(f) for f in list(files) for x in file_excl if re.search(x, os.path.join(root, f))]
             [files.remove(f) for f in list(files) if not os.path.isfile(os.path.join(root, f))]
             yield root, dirs, files
+
+    def cache_load(self, name, default):
+        try:
+            with open(os.path.join(cache_dir, f'{name}.json'), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return default
+
+    def cache_save(self, name, data):
+        # replace atomically, concurrent cron runs might read at the same time
+        os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, f'{name}.json')
+        with open(f'{path}.{os.getpid()}', 'w') as f:
+            json.dump(data, f)
+        os.replace(f'{path}.{os.getpid()}', path)
+
+    def mem_available(self):
+        with open('/proc/meminfo', 'r') as f:
+            return next(int(x.split()[1]) for x in f if x.startswith('MemAvailable:')) * 1024
+
+    def emerge_estimator(self):
+        # - build durations per package from emerge.log, averaged over the latest builds
+        # - packages without history are scaled by installed size (vdb) using the median seconds per byte
+        import portage
+        import portage.versions
+        import statistics
+        trees = portage.create_trees()
+        vardb = trees[portage.settings['EROOT']]["vartree"].dbapi
+
+        starts = dict()
+        durations = dict()
+        with open(emerge_log, 'r', errors='replace') as f:
+            for match in filter(None, map(emerge_log_regex.match, f)):
+                ts, event, cpv = match.groups()
+                if event == '>>> emerge':
+                    starts[cpv] = int(ts)
+                elif cpv in starts:
+                    durations.setdefault(portage.versions.cpv_getkey(cpv), list()).append(int(ts) - starts.pop(cpv))
+        durations = {k: sum(v[-5:]) / len(v[-5:]) for k,v in durations.items()}
+
+        sizes = dict()
+        def size(key):
+            if key not in sizes:
+                try:
+                    sizes[key] = int(vardb.aux_get(vardb.match(key)[-1], ['SIZE'])[0])
+                except (IndexError, KeyError, ValueError):
+                    sizes[key] = 0
+            return sizes[key]
+        rates = [v / size(k) for k,v in durations.items() if size(k)]
+        rate = statistics.median(rates) if rates else 0
+        default = statistics.median(durations.values()) if durations else 0
+
+        def estimate(cpv):
+            key = portage.versions.cpv_getkey(cpv)
+            return durations.get(key) or size(key) * rate or default
+        return estimate
+
+    def baseline_files(self, files):
+        # - owner lookup & hashing of config files through the vdb is slow => cache results per file
+        # - cache entries stay valid while file size/mtime and the owning package COUNTER are unchanged
+        # - unowned files are rechecked after any merge (global vdb counter)
+        import gentoolkit.equery.check
+        import gentoolkit.helpers
+        import portage
+        import threading
+        gtk_check = gentoolkit.equery.check.VerifyContents()
+        gtk_find = gentoolkit.helpers.FileOwner()
+        trees = portage.create_trees()
+        vardb = trees[portage.settings['EROOT']]["vartree"].dbapi
+        counter_now = str(vardb.get_counter_tick_core())
+
+        counters = dict()
+        def counter(pkg):
+            if pkg not in counters:
+                try:
+                    counters[pkg] = vardb.aux_get(pkg, ['COUNTER'])[0]
+                except KeyError:
+                    # package has been uninstalled
+                    counters[pkg] = None
+            return counters[pkg]
+
+        cache = self.cache_load('baseline', dict())
+        result = dict()
+        stats = dict()
+        for f in files:
+            try:
+                st = os.stat(f)
+            except FileNotFoundError:
+                continue
+            stats[f] = (st.st_size, st.st_mtime_ns)
+            entry = cache.get(f)
+            if (entry and
+                (entry['size'], entry['mtime']) == stats[f] and
+                entry['counter'] == (counter(entry['pkg']) if entry['pkg'] else counter_now)):
+                result[f] = entry
+        stale = sorted(set(stats) - set(result))
+        self.ui.debug(f'Verifying {len(stale)} of {len(stats)} files against baseline')
+
+        def entry(path, pkg, equivalent):
+            return {
+                'size': stats[path][0],
+                'mtime': stats[path][1],
+                'pkg': pkg,
+                'counter': counter(pkg) if pkg else counter_now,
+                'equivalent': equivalent,
+            }
+
+        # - a single owner lookup, every FileOwner call walks the CONTENTS of all installed packages
+        # - only the per-package content checks run as parallel jobs
+        owners = dict()
+        if stale:
+            for pkg, path in gtk_find(stale):
+                owners.setdefault(str(pkg), set()).add(path)
+
+        # paths owned by several packages are equivalent if any of them matches
+        lock = threading.Lock()
+        def check_job(pkg, paths):
+            check = {k:v for k,v in vardb._dblink(pkg).getcontents().items() if k in paths}
+            (n_passed, n_checked, errs) = gtk_check._run_checks(check)
+            failed = set(x.split()[0] for x in errs)
+            with lock:
+                for path in paths:
+                    if path not in result or not result[path]['equivalent']:
+                        result[path] = entry(path, pkg, path in check and path not in failed)
+        for pkg, paths in owners.items():
+            self.dispatch(check_job, pkg=pkg, paths=paths,
+                          blocking=False)
+        self.join()
+
+        for path in stale:
+            if path not in result:
+                result[path] = entry(path, None, False)
+
+        self.cache_save('baseline', result)
+        return sorted(k for k,v in result.items() if v['equivalent'])
+
+    def git_status_caches(self, repo):
+        # - root filesystem repo needs to stat every tracked file and scan for untracked paths on each status query
+        # - untracked cache + split index + fsmonitor reduce repeated queries to changed paths only
+        # - fsmonitor hook is backed by watchman (inotify), git ships the hook as template sample
+        git_cmd = f'cd {repo} && /usr/bin/git'
+        watchman = os.path.exists('/usr/bin/watchman')
+        try:
+            enabled = {x.split()[0] for x in self.dispatch(f'{git_cmd} config --get-regexp "^core\\.(untrackedcache|splitindex|fsmonitor)$"',
+                                                           output=None, passive=True).stdout}
+        except self.exc_class:
+            enabled = set()
+        if {'core.untrackedcache', 'core.splitindex'} <= enabled and ('core.fsmonitor' in enabled or not watchman):
+            return
+
+        def status_time():
+            start = time.time()
+            self.dispatch(f'{git_cmd} status --porcelain',
+                          output=None, passive=True)
+            return time.time() - start
+
+        before = status_time()
+        self.ui.info(f'Enabling git status caches for {repo}...')
+        self.dispatch(f'{git_cmd} config core.untrackedCache true && '
+                      f'{git_cmd} config core.splitIndex true && '
+                      f'{git_cmd} update-index --untracked-cache --split-index')
+        if watchman:
+            hook = os.path.join(repo, '.git', 'hooks', 'query-watchman')
+            self.dispatch(f'/bin/cp /usr/share/git-core/templates/hooks/fsmonitor-watchman.sample {hook} && '
+                          f'/bin/chmod +x {hook} && '
+                          f'{git_cmd} config core.fsmonitor {hook}')
+        else:
+            self.ui.warning('watchman not installed, skipping fsmonitor hook')
+
+        # first query populates caches and starts watching
+        status_time()
+        self.ui.info(f'git status timing for {repo}: {before:.2f}s before, {status_time():.2f}s after')
             
+    def keyring_sync(self, src, dest, excludes, apply):
+        # - rsync compares metadata of every file on the slow vfat keyring
+        # - a manifest of the last written state (per keyring filesystem) yields a delta plan instead
+        # - content hashes are only recomputed for source files with changed size/mtime
+        import hashlib
+        import shutil
+        block = 16*1024**2
+
+        # st_dev of the mounted keyring matches the device node of its by-uuid link
+        dev = os.stat(dest).st_dev
+        uuid = next((x.name for x in os.scandir('/dev/disk/by-uuid') if os.stat(x.path).st_rdev == dev), 'unknown')
+        manifests = self.cache_load('keyring_manifest', dict())
+        manifest = manifests.setdefault(uuid, {'files': dict(), 'throughput': None})
+        files = manifest['files']
+
+        def excluded(rel):
+            return any(re.search(x, rel) for x in excludes)
+        def digest(path):
+            md5 = hashlib.md5()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(block), b''):
+                    md5.update(chunk)
+            return md5.hexdigest()
+        def dest_stat(rel):
+            try:
+                return os.stat(os.path.join(dest, rel))
+            except FileNotFoundError:
+                return None
+
+        source = dict()
+        copy = list()
+        for root, dirs, names in os.walk(src):
+            for name in names:
+                rel = os.path.relpath(os.path.join(root, name), src)
+                if excluded(rel):
+                    continue
+                st = os.stat(os.path.join(src, rel))
+                entry = files.get(rel)
+                if entry and entry[:2] == [st.st_size, st.st_mtime_ns]:
+                    md5 = entry[2]
+                else:
+                    md5 = digest(os.path.join(src, rel))
+                source[rel] = [st.st_size, st.st_mtime_ns, md5]
+                # without manifest entry (first run, new keyring), copies matching in size & mtime are adopted
+                # - vfat stores mtimes with 2s resolution
+                dest_st = dest_stat(rel)
+                if (not dest_st or dest_st.st_size != st.st_size or
+                    (entry[2] != md5 if entry else abs(dest_st.st_mtime_ns - st.st_mtime_ns) > 2*10**9)):
+                    copy.append(rel)
+
+        # only directory listings are needed on the keyring to find obsolete files
+        delete = list()
+        for root, dirs, names in os.walk(dest):
+            rel_root = os.path.relpath(root, dest)
+            dirs[:] = [d for d in dirs if not excluded(os.path.normpath(os.path.join(rel_root, d)))]
+            delete.extend(rel for rel in (os.path.normpath(os.path.join(rel_root, x)) for x in names)
+                          if rel not in source and not excluded(rel))
+
+        total = sum(source[x][0] for x in copy)
+        eta = f', ETA {total / manifest["throughput"]:.0f}s' if manifest['throughput'] else ''
+        self.ui.info(f'Keyring {uuid}: copying {len(copy)} files ({total / 1024**2:.1f}MiB{eta}), deleting {len(delete)} files')
+        for rel in copy:
+            self.ui.info(f'copy   {rel}')
+        for rel in delete:
+            self.ui.info(f'delete {rel}')
+        if not apply:
+            return
+
+        try:
+            for rel in delete:
+                os.remove(os.path.join(dest, rel))
+                files.pop(rel, None)
+            for root, dirs, names in os.walk(dest, topdown=False):
+                rel = os.path.relpath(root, dest)
+                if rel != '.' and not excluded(rel) and not os.path.isdir(os.path.join(src, rel)) and not os.listdir(root):
+                    os.rmdir(root)
+
+            # unchanged content, only source metadata differs
+            files.update({k:v for k,v in source.items() if k not in copy})
+
+            written = 0
+            start = time.time()
+            for idx, rel in enumerate(copy):
+                path = os.path.join(dest, rel)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # large sequential writes, flushed per file to measure actual device throughput
+                with open(os.path.join(src, rel), 'rb') as fsrc, open(path, 'wb') as fdst:
+                    shutil.copyfileobj(fsrc, fdst, block)
+                    fdst.flush()
+                    os.fsync(fdst.fileno())
+                os.utime(path, ns=(source[rel][1], source[rel][1]))
+                files[rel] = source[rel]
+                written += source[rel][0]
+                elapsed = time.time() - start
+                rate = written / elapsed if elapsed else 0
+                eta = (total - written) / rate if rate else 0
+                self.ui.info(f'[{idx+1}/{len(copy)}] {rel}: {rate / 1024**2:.1f}MiB/s, ETA {eta:.0f}s')
+            if written > 64*1024**2:
+                manifest['throughput'] = written / (time.time() - start)
+        finally:
+            self.cache_save('keyring_manifest', manifests)
+
     @pylon.log_exec_time
     def admin_check_audio(self):
         # ====================================================================
@@ -802,15 +1085,7 @@ class admin(pylon.base.base):
             ('/usr/bin', False),
         )
 
-        import gentoolkit.equery.check
-        import gentoolkit.helpers
-        import portage
         git_url = 'https://github.com/nilathak/gentoo-root.git'
-        gtk_check = gentoolkit.equery.check.VerifyContents()
-        gtk_find = gentoolkit.helpers.FileOwner()
-        trees = portage.create_trees()
-        vardb = trees[portage.settings['EROOT']]["vartree"].dbapi
-        vardb_path = os.path.join(portage.settings['EROOT'], portage.const.VDB_PATH)
         
         for repo,baseline_check in repos:
             git_cmd = f'cd {repo} && /usr/bin/git'
@@ -831,42 +1106,44 @@ class admin(pylon.base.base):
                                   output='stderr')
             else:
                 self.ui.info(f'######################### Checking repo at {repo}...')
+                self.git_status_caches(repo)
+
+                # - one name-status diff per ref pair, pathspec filtering is done client-side
+                # - avoids passing whole file lists on the command line
+                def name_status(refs):
+                    out = self.dispatch(f'{git_cmd} diff --no-renames --name-status {refs}',
+                                        output=None, passive=True).stdout
+                    return dict(reversed(x.split('\t', 1)) for x in out if x)
+                def status_lines(status, files):
+                    return [f'{status[x]}\t{x}' for x in files if x in status]
 
                 # host branch existing?
-                try:
-                    self.dispatch(f'{git_cmd} branch | /bin/grep {self.ui.hostname}',
-                                  output=None, passive=True)
-                except self.exc_class:
-                    host_files = list()
-                    host_files_diff = list()
-                else:
+                if self.dispatch(f'{git_cmd} for-each-ref --format="%(refname:short)" refs/heads/{self.ui.hostname}',
+                                 output=None, passive=True).stdout:
                     # Finding host-specific files (host-only + superimposed)
-                    host_files_actual = self.dispatch(f'{git_cmd} diff origin/master {self.ui.hostname} --name-only', output=None, passive=True).stdout
+                    host_files_actual = name_status(f'origin/master {self.ui.hostname}')
                     # host branches can only modify files from master branch or add new ones
-                    host_files = self.dispatch(f'{git_cmd} diff origin/master {self.ui.hostname} --name-only --diff-filter=AM', output=None, passive=True).stdout
-                    host_files.sort()
+                    host_files = sorted(k for k,v in host_files_actual.items() if v in ('A', 'M'))
                     host_files_unexpect = set(host_files_actual) - set(host_files)
                     if host_files_unexpect:
                         raise self.exc_class(f'unexpected host-specific diff:{os.linesep}{os.linesep.join(sorted(host_files_unexpect))}')
-                    host_files_diff = self.dispatch(f'{git_cmd} diff {self.ui.hostname} --name-only -- {" ".join(host_files)}',
-                                                    output=None, passive=True).stdout
+                    host_files_stat = status_lines(name_status(self.ui.hostname), host_files)
+                else:
+                    host_files = list()
+                    host_files_stat = list()
 
                 # Finding master-specific files (common files)
                 all_files = self.dispatch(f'{git_cmd} ls-files',
                                           output=None, passive=True).stdout
                 master_files = list(set(all_files) - set(host_files))
                 master_files.sort()
-                master_files_diff = self.dispatch(f'{git_cmd} diff origin/master --name-only -- {" ".join(master_files)}',
-                                                  output=None, passive=True).stdout
+                master_status = name_status('origin/master')
+                master_files_stat = status_lines(master_status, master_files)
 
                 # display repo status
-                if host_files_diff:
-                    host_files_stat = self.dispatch(f'{git_cmd} diff {self.ui.hostname} --name-status -- {" ".join(host_files)}',
-                                                    output=None, passive=True).stdout
+                if host_files_stat:
                     self.ui.info(f'Host status:{os.linesep}{os.linesep.join(host_files_stat)}')
-                if master_files_diff:
-                    master_files_stat = self.dispatch(f'{git_cmd} diff origin/master --name-status -- {" ".join(master_files)}',
-                                                      output=None, passive=True).stdout
+                if master_files_stat:
                     self.ui.info(f'Master status:{os.linesep}{os.linesep.join(master_files_stat)}')
 
                     # export master changes to avoid checking out master branch instead of host branch
@@ -875,24 +1152,36 @@ class admin(pylon.base.base):
                         clone_path = f'/tmp/{os.path.basename(git_url)}'
                         self.ui.info(f'Preparing temporary master repo for {repo} into {clone_path}...')
                         self.dispatch(f'/bin/rm -rf {clone_path}')
-                        self.dispatch(f'{git_cmd} clone {git_url} {clone_path}',
-                                      output='stderr')
-                        for f in master_files:
-                            self.dispatch(f'/bin/cp {os.path.join(repo, f)} {os.path.join(clone_path, f)}',
+                        if self.ui.args.local_clone:
+                            # borrow objects from local repo via alternates, only origin/master ref is fetched
+                            self.dispatch(f'/usr/bin/git init -q {clone_path} && '
+                                          f'echo {os.path.join(repo, ".git", "objects")} > {clone_path}/.git/objects/info/alternates && '
+                                          f'cd {clone_path} && '
+                                          f'/usr/bin/git remote add origin {git_url} && '
+                                          f'/usr/bin/git fetch -q {repo} +refs/remotes/origin/master:refs/remotes/origin/master && '
+                                          f'/usr/bin/git checkout -q -b master --track origin/master',
+                                          output='stderr')
+                        else:
+                            self.dispatch(f'{git_cmd} clone {git_url} {clone_path}',
                                           output='stderr')
 
+                        # - unchanged master files are identical in clone anyway
+                        # - single bulk copy of modified files
+                        copy_files = [x for x in master_files if x in master_status and master_status[x] != 'D']
+                        if copy_files:
+                            with tempfile.NamedTemporaryFile('w') as files_from:
+                                files_from.write(os.linesep.join(copy_files) + os.linesep)
+                                files_from.flush()
+                                self.dispatch(f'/usr/bin/rsync -a --files-from={files_from.name} {repo} {clone_path}',
+                                              output='stderr')
+
                 # all portage files in config repo should differ from gentoo baseline, report otherwise (should be deleted from repo manually)
                 if baseline_check:
                     self.ui.info(f'Comparing portage files in repo {repo} against baseline...')
                     repo_files = list(set(host_files) | set(master_files))
                     repo_files_abs = [f'/{x}' for x in repo_files]
-                    affected_pkgs = {str(x[0]) for x in gtk_find(repo_files_abs)}
-                    for pkg in affected_pkgs:
-                        check = {k:v for k,v in vardb._dblink(pkg).getcontents().items() if k in repo_files_abs}
-                        (n_passed, n_checked, errs) = gtk_check._run_checks(check)
-                        if n_passed:
-                            for path in set(set(check.keys()) - set(x.split()[0] for x in errs)):
-                                self.ui.warning(f'File is equivalent to gentoo baseline: {path}')
+                    for path in self.baseline_files(repo_files_abs):
+                        self.ui.warning(f'File is equivalent to gentoo baseline: {path}')
                             
                 # optionally display repo files
                 if self.ui.args.list_files:
@@ -905,13 +1194,41 @@ class admin(pylon.base.base):
     def admin_kernel(self):
         # ====================================================================
         'scripting stuff to build kernels'
+        import math
         import multiprocessing
         
         key_mp = '/tmp/keyring'
         key_image = '/mnt/work/usb_boot'
+
+        # wall time of each build step is appended to a history file for tuning
+        history = self.cache_load('kernel_history', list())
+        timings = dict()
+        def step(name, cmd, **kwargs):
+            start = time.time()
+            job = self.dispatch(cmd, **kwargs)
+            timings[name] = round(time.time() - start, 1)
+            return job
+
+        # - limit jobs by available memory (approx. 512MiB per compiler instance) and current load
+        # - load average limit prevents overcommitting if other jobs start during the build
+        #   the build itself may reach its jobs on top of the starting load, keeps the deliberate oversubscription
+        cpus = multiprocessing.cpu_count()
+        mem_avail = self.mem_available()
+        load = os.getloadavg()[0]
+        jobs = max(1, min(cpus*2-1, mem_avail // 512 // 1024**2, round(cpus*2-1 - load)))
+        max_load = math.ceil(jobs + load)
+        self.ui.info(f'Building with {jobs} jobs, load limit {max_load} (load {load:.1f}, {mem_avail // 1024**2}MiB available)...')
         
         os.chdir('/usr/src/linux')
-        self.dispatch(f'/usr/bin/make -j{str(multiprocessing.cpu_count()*2-1)}', output='nopipes')
+        step('build', f'/usr/bin/make -j{jobs} -l{max_load}', output='nopipes')
+
+        # modules do not depend on keyring installation
+        def modules_job():
+            self.ui.info('Rebuild kernel modules')
+            step('modules_install', '/usr/bin/make modules_install')
+            step('module_rebuild', '/usr/bin/emerge @module-rebuild', output='nopipes')
+        self.dispatch(modules_job,
+                      blocking=False)
 
         # install kernel to USB keyrings
         try:
@@ -940,33 +1257,33 @@ class admin(pylon.base.base):
             pass
 
         self.dispatch(f'/bin/mount {part} {key_mp}')
-        self.dispatch('/usr/bin/make install')
+        step('install', '/usr/bin/make install')
 
         self.ui.info('install grub modules + embed into boot sector')
-        self.dispatch(f'/usr/sbin/grub-install {dev} --boot-directory={key_mp}/boot')
+        step('grub_install', f'/usr/sbin/grub-install {dev} --boot-directory={key_mp}/boot')
         self.ui.info('rsync new grub installation to keyring backup')
-        self.dispatch(f'/usr/bin/rsync -a {key_mp}/boot/grub/ {key_image}/boot/grub/ --exclude="grub.cfg"',
-                      output='both')
+        step('grub_rsync', f'/usr/bin/rsync -a {key_mp}/boot/grub/ {key_image}/boot/grub/ --exclude="grub.cfg"',
+             output='both')
         self.ui.info('install host-specific grub.cfg (grub detects underlying device and correctly uses absolute paths to kernel images)')
-        self.dispatch('/usr/sbin/grub-mkconfig -o /boot/grub/grub.cfg')
+        step('grub_mkconfig', '/usr/sbin/grub-mkconfig -o /boot/grub/grub.cfg')
 
-        self.ui.info('rsync keyring backup to actual device')
-        rsync_exclude = [
+        self.ui.info('sync keyring backup to actual device')
+        sync_exclude = [
             # kernels & grub.cfgs
-            '--exclude="/diablo"',
+            '^diablo(/|$)',
         ]
-        rsync_exclude_small = [
-            '--include="/systemrescuecd*.iso"',
-            '--exclude="/*.iso"',
+        sync_exclude_small = [
+            r'^(?!systemrescuecd)[^/]*\.iso$',
         ]
         if self.ui.args.small:
-            rsync_exclude += rsync_exclude_small 
-        dry_run = ''
+            sync_exclude += sync_exclude_small
         if not self.ui.args.force:
             self.ui.info('Use -f to apply sync!')
-            dry_run = 'n'
-        self.dispatch(f'/usr/bin/rsync -av{dry_run} --modify-window 1 --no-perms --no-owner --no-group --inplace --delete {key_image}/ {key_mp} {" ".join(rsync_exclude)}',
-                      output='both')
+        step('keyring_sync', self.keyring_sync,
+             src=key_image,
+             dest=key_mp,
+             excludes=sync_exclude,
+             apply=self.ui.args.force and not self.ui.args.dry_run)
 
         try:
             while True:
@@ -975,9 +1292,23 @@ class admin(pylon.base.base):
             pass
 
         self.dispatch('/bin/rm /boot')
-        self.ui.info('Rebuild kernel modules')
-        self.dispatch('/usr/bin/make modules_install')
-        self.dispatch('/usr/bin/emerge @module-rebuild', output='nopipes')
+        self.join()
+
+        self.ui.info('Build step timings (current/average):')
+        for name, secs in timings.items():
+            past = [x['steps'][name] for x in history if name in x['steps']]
+            avg = sum(past + [secs]) / (len(past) + 1)
+            self.ui.info(f'{name:>16}: {secs:8.1f}s {avg:8.1f}s')
+        if not self.ui.args.dry_run:
+            history.append({
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'jobs': jobs,
+                'max_load': max_load,
+                'load': round(load, 2),
+                'mem_avail': mem_avail,
+                'steps': timings,
+            })
+            self.cache_save('kernel_history', history[-100:])
 
     def admin_open_vault(self):
         # ====================================================================
@@ -1015,25 +1346,32 @@ class admin(pylon.base.base):
         # ====================================================================
         'force offline HDD array into standby mode'
 
-        # import supported on diablo only
-        import psutil
-        
         disks = ('/dev/disk/by-id/ata-WDC_WD60EFRX-68L0BN1_WD-WX11D3743LU8',
                  '/dev/disk/by-id/ata-WDC_WD60EFRX-68MYMN1_WD-WX41DA427KFT')
         mount_point = '/mnt/work/backup/offline'
-                
-        # script will be run asynchronously by various cron scripts, so ensure the disks are really idle
-        self.ui.debug('checking for ongoing IO operations using a practical hysteresis')
-
-        # monitor activity of a single RAID1 device
-        sd_path = os.path.realpath(disks[0])
-        partition = sd_path.split('/')[-1]+'1'
-        io_ops_1st = str(psutil.disk_io_counters(True)[partition])
-            
-        time.sleep(5*60)
-
-        io_ops_2nd = str(psutil.disk_io_counters(True)[partition])
-        if io_ops_1st == io_ops_2nd:
+        poll = 10
+        window = self.ui.args.window * 60
+
+        # monitor all RAID1 member disks (including partitions) via kernel block layer counters
+        members = [os.path.basename(os.path.realpath(x)) for x in disks]
+        def io_counters():
+            with open('/proc/diskstats', 'r') as f:
+                # reads, sectors read, writes, sectors written
+                return {x[2]: tuple(x[i] for i in (3, 5, 7, 9)) for x in (l.split() for l in f) if x[2] in members}
+
+        def idle():
+            # script will be run asynchronously by various cron scripts, so ensure the disks are really idle
+            # bail out as soon as any activity shows up within the idle window
+            self.ui.debug('checking for ongoing IO operations using a practical hysteresis')
+            start = io_counters()
+            deadline = time.time() + window
+            while time.time() < deadline:
+                time.sleep(max(0, min(poll, deadline - time.time())))
+                if io_counters() != start:
+                    return False
+            return True
+
+        def spindown():
             self.ui.debug('Ensure filesystem buffers are flushed')
             self.dispatch(f'/sbin/btrfs filesystem sync {mount_point}',
                           output=None)
@@ -1042,11 +1380,46 @@ class admin(pylon.base.base):
                 self.dispatch(f'/sbin/hdparm -y {disk}',
                               output=None)
 
+        if not self.ui.args.daemon:
+            if idle():
+                spindown()
+            return
+
+        self.ui.info(f'Spinning down array after {self.ui.args.window} idle minutes...')
+        while True:
+            if idle():
+                spindown()
+                # re-arm only after the array has been woken up again
+                asleep = io_counters()
+                while io_counters() == asleep:
+                    time.sleep(poll)
+
     def admin_update(self):
         # ====================================================================
         'update portage'
         
         import portage
+        trees = portage.create_trees()
+        vardb = trees[portage.settings['EROOT']]["vartree"].dbapi
+        world_file = '/var/lib/portage/world'
+
+        # - phase progress survives interrupted runs (cron collision, failed package)
+        # - depclean & preserved-rebuild are only repeated after new merges (vdb COUNTER)
+        state = self.cache_load('update_state', dict())
+        def record(**kwargs):
+            if not self.ui.args.dry_run:
+                state.update(kwargs)
+                self.cache_save('update_state', state)
+        def counter():
+            return str(vardb.get_counter_tick_core())
+        def resumable():
+            # interrupted world update leaves its merge list in mtimedb
+            try:
+                with open(emerge_mtimedb, 'r') as f:
+                    resume = json.load(f)['resume']
+                return bool(resume['mergelist']) and any(x.lstrip('@') == 'world' for x in resume['favorites'])
+            except (FileNotFoundError, KeyError, ValueError):
+                return False
         
         if self.ui.args.sync:
             self.ui.info('Synchronizing repositories...')
@@ -1073,25 +1446,110 @@ class admin(pylon.base.base):
 
         pretend = '-p' if not self.ui.args.force else ''
         options = self.ui.args.options or ''
+
+        # - parallel package builds limited by memory (approx. 2GiB per package including MAKEOPTS jobs)
+        # - load average limit keeps MAKEOPTS parallelism of concurrent builds in check
+        import multiprocessing
+        import threading
+        cpus = multiprocessing.cpu_count()
+        jobs = max(1, min(cpus // 4, self.mem_available() // 2 // 1024**3))
+        schedule = f'--jobs={jobs} --load-average={cpus}'
+        estimate = self.emerge_estimator()
+
+        def wall(secs):
+            return max(max(secs), sum(secs) / jobs) if secs else 0
+        def report(pending):
+            estimates = sorted(((estimate(x), x) for x in pending), reverse=True)
+            self.ui.info(f'Estimated update time for {len(pending)} packages: {wall([x[0] for x in estimates]) / 60:.0f}min ({schedule})')
+            for secs, cpv in estimates[:5]:
+                self.ui.info(f'{secs / 60:8.1f}min {cpv}')
+            return {cpv: secs for secs, cpv in estimates}
+
+        def eta_job(stop):
+            start = time.time()
+            with open(emerge_log, 'r', errors='replace') as log:
+                log.seek(0, os.SEEK_END)
+                # merge list is stored as resume list right after dependency calculation
+                while not stop.wait(5):
+                    try:
+                        if os.stat(emerge_mtimedb).st_mtime >= start:
+                            with open(emerge_mtimedb, 'r') as f:
+                                left = report([x[2] for x in json.load(f)['resume']['mergelist']])
+                            break
+                    except (FileNotFoundError, KeyError, ValueError):
+                        pass
+                else:
+                    return
+                while not stop.is_set():
+                    line = log.readline()
+                    if not line:
+                        stop.wait(5)
+                        continue
+                    match = emerge_log_regex.match(line)
+                    if match and match.group(2) == '::: completed emerge' and match.group(3) in left:
+                        del left[match.group(3)]
+                        self.ui.info(f'Completed {match.group(3)}, ETA {wall(list(left.values())) / 60:.0f}min')
+
         self.ui.info('Checking for updates...')
-        try:
-            self.dispatch(f'/usr/bin/emerge --nospinner -uDNv world {pretend} {options}',
-                          output='nopipes')
-        except self.exc_class:
-            pass
+        if self.ui.args.force:
+            target = '-uDNv world'
+            if state.get('phase') == 'world' and resumable():
+                self.ui.info('Resuming interrupted world update...')
+                target = '--resume'
+            record(phase='world')
+            stop = threading.Event()
+            self.dispatch(eta_job, stop=stop,
+                          blocking=False)
+            try:
+                self.dispatch(f'/usr/bin/emerge --nospinner {target} {schedule} {options}',
+                              output='nopipes')
+            except self.exc_class:
+                # failed package: phase stays at world, depclean & preserved-rebuild wait for a completed world update
+                self.ui.error('World update failed, next forced run resumes it')
+                return
+            else:
+                record(phase='depclean')
+            finally:
+                stop.set()
+                self.join()
+        else:
+            try:
+                out = self.dispatch(f'/usr/bin/emerge --nospinner -uDNv world {pretend} {schedule} {options}',
+                                    output='both').stdout
+            except self.exc_class:
+                pass
+            else:
+                pending = [x.group(1).split('::')[0] for x in map(re.compile(r'^\[(?:ebuild|binary)[^\]]*\] (\S+)').match, out) if x]
+                if pending:
+                    report(pending)
         
         self.ui.info('Checking for obsolete dependencies...')
-        self.dispatch(f'/usr/bin/emerge --depclean {pretend}',
-                      output='nopipes')
+        depclean_key = [counter(), os.stat(world_file).st_mtime_ns]
+        if state.get('depclean') == depclean_key:
+            self.ui.info('No merges since last depclean, skipping...')
+        else:
+            self.dispatch(f'/usr/bin/emerge --depclean {pretend}',
+                          output='nopipes')
+            if self.ui.args.force:
+                record(phase='preserved', depclean=depclean_key)
 
         if self.ui.args.force:
             self.ui.info('Rebuilding broken lib dependencies...')
-            self.dispatch('/usr/bin/emerge @preserved-rebuild',
-                          output='nopipes')
+            if state.get('preserved') == counter():
+                self.ui.info('No merges since last preserved-rebuild, skipping...')
+            else:
+                self.dispatch('/usr/bin/emerge @preserved-rebuild',
+                              output='nopipes')
+                # rebuilt packages advance the counter themselves
+                record(preserved=counter())
+            record(phase='done')
 
     def admin_wrap(self):
         # ====================================================================
         'mount wrap image for local administration'
+        import fcntl
+        import signal
+        import tempfile
 
         image = '/mnt/work/hypnocube/WRAP.1E.img'
         local = '/tmp/wrap'
@@ -1122,19 +1580,131 @@ class admin(pylon.base.base):
             ('/sys', '/sys'),
             ('/tmp', '/tmp'),
             )
+
+        # - change journal records modified paths of all sessions until the next successful sync
+        # - journal is only trusted if the device was in sync when recording started
+        sessions = '/run/admin_wrap'
+        journal = os.path.join(cache_dir, 'wrap_journal')
+        journal_pid = os.path.join(sessions, 'journal.pid')
+        def journal_trusted(trusted):
+            state = self.cache_load('wrap_state', dict())
+            state['journal'] = trusted
+            self.cache_save('wrap_state', state)
+
+        def journal_start():
+            # bind mounted host trees are not watched
+            excl = '|'.join(dest.strip('/') for (src, dest) in bind_map)
+            os.makedirs(cache_dir, exist_ok=True)
+            try:
+                pid = int(self.dispatch(f"/usr/bin/inotifywait -m -r --format '%e %w%f' "
+                                        f"-e modify,attrib,close_write,create,delete,move "
+                                        f"--exclude '^{local}/({excl})(/|$)' {local} "
+                                        f">> {journal} 2> {journal}.log < /dev/null & echo $!",
+                                        output=None).stdout[0])
+                # watches need to be established before entering the chroot
+                while True:
+                    os.kill(pid, 0)
+                    with open(f'{journal}.log', 'r') as f:
+                        if 'Watches established' in f.read():
+                            break
+                    time.sleep(0.5)
+                with open(journal_pid, 'w') as f:
+                    f.write(str(pid))
+            except (self.exc_class, ProcessLookupError, FileNotFoundError):
+                self.ui.warning('Change journal not available, next sync needs a full rsync...')
+                journal_trusted(False)
+
+        def journal_stop():
+            try:
+                with open(journal_pid, 'r') as f:
+                    pid = int(f.read())
+                os.remove(journal_pid)
+                os.kill(pid, signal.SIGTERM)
+            except (FileNotFoundError, ProcessLookupError, ValueError):
+                # watcher died during the session, changes might be missing
+                journal_trusted(False)
+
+        def journal_changes():
+            # returns changed paths & newly created directories (need recursive transfer)
+            if not self.cache_load('wrap_state', dict()).get('journal'):
+                return None
+            paths = set()
+            dirs = set()
+            with open(journal, 'r', errors='replace') as f:
+                for line in f:
+                    events, _, path = line.rstrip(os.linesep).partition(' ')
+                    if 'Q_OVERFLOW' in events:
+                        return None
+                    rel = os.path.relpath(path, local)
+                    paths.add(rel)
+                    if 'ISDIR' in events and ('CREATE' in events or 'MOVED_TO' in events):
+                        dirs.add(rel)
+            return paths, dirs
+
+        def rsync_files_from(files, flags):
+            with tempfile.NamedTemporaryFile('w') as files_from:
+                files_from.write(os.linesep.join(sorted(files)) + os.linesep)
+                files_from.flush()
+                self.dispatch(f'/usr/bin/rsync -aHv {flags} --files-from={files_from.name} {local}/ {device}:/ {" ".join(rsync_exclude)}',
+                              output='both')
+
+        def sync():
+            changes = journal_changes()
+            if changes is None:
+                self.dispatch(f'/usr/bin/rsync -aHv --delete {local}/ {device}:/ {" ".join(rsync_exclude)}',
+                              output='both')
+            else:
+                paths, dirs = changes
+                if not paths:
+                    self.ui.info('No changes recorded since last sync')
+                    return False
+                self.ui.info(f'Syncing {len(paths)} journaled paths...')
+                try:
+                    # deleted paths are removed on device as missing source args
+                    rsync_files_from(paths, '--delete-missing-args')
+                    if dirs:
+                        rsync_files_from(dirs, '-r --delete')
+                except self.exc_class:
+                    self.ui.warning('Incremental sync failed, falling back to full rsync...')
+                    self.dispatch(f'/usr/bin/rsync -aHv --delete {local}/ {device}:/ {" ".join(rsync_exclude)}',
+                                  output='both')
+            # device is in sync with image now
+            open(journal, 'w').close()
+            journal_trusted(True)
+            return True
      
-        # first instance does mounting
-        os.makedirs(local, exist_ok=True)
-        try:
-            self.dispatch(f'/bin/mount | /bin/grep {local}',
-                          output=None, passive=True)
-        except self.exc_class:
-            self.dispatch(f'/bin/mount {image} {local}',
-                          output='stderr')
-            for (src, dest) in bind_map:
-                os.makedirs(src, exist_ok=True)
-                self.dispatch(f'/bin/mount -o bind {src} {os.path.join(local, dest.strip("/"))}',
+        # - every session holds a flock on its own session file, crashed sessions release it automatically
+        # - global lock serializes mounting/umounting against entering sessions
+        def active_sessions():
+            count = 0
+            for entry in os.scandir(sessions):
+                if entry.name.startswith('session.'):
+                    with open(entry.path, 'r') as f:
+                        try:
+                            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except BlockingIOError:
+                            count += 1
+                        else:
+                            os.remove(entry.path)
+            return count
+
+        os.makedirs(sessions, exist_ok=True)
+        session_path = os.path.join(sessions, f'session.{os.getpid()}')
+        with open(os.path.join(sessions, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            session = open(session_path, 'w')
+            fcntl.flock(session, fcntl.LOCK_EX)
+
+            # first instance does mounting
+            os.makedirs(local, exist_ok=True)
+            if not os.path.ismount(local):
+                self.dispatch(f'/bin/mount {image} {local}',
                               output='stderr')
+                for (src, dest) in bind_map:
+                    os.makedirs(src, exist_ok=True)
+                    self.dispatch(f'/bin/mount -o bind {src} {os.path.join(local, dest.strip("/"))}',
+                                  output='stderr')
+                journal_start()
      
         self.ui.info('Entering the chroot...')
 
@@ -1152,36 +1722,38 @@ class admin(pylon.base.base):
         self.ui.info('Leaving the chroot...')
      
         # last instance does umounting
-        if len([x for x in self.dispatch('/bin/ps aux | /bin/grep admin.py',
-                                         output=None,
-                                         passive=True).stdout if ' wrap' in x]) == 1:
-            for (src, dest) in reversed(bind_map):
-                self.dispatch(f'/bin/umount {os.path.join(local, dest.strip("/"))}',
-                              output='stderr')
+        with open(os.path.join(sessions, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            session.close()
+            os.remove(session_path)
+            if not active_sessions():
+                journal_stop()
+                for (src, dest) in reversed(bind_map):
+                    self.dispatch(f'/bin/umount {os.path.join(local, dest.strip("/"))}',
+                                  output='stderr')
      
-            try:
-                if self.ui.args.sync:
-                    self.ui.info('Syncing changes to device...')
-                    try:
-                        self.dispatch(f'/bin/ping {device} -c 1',
-                                      output='stderr')
+                try:
+                    if self.ui.args.sync:
+                        self.ui.info('Syncing changes to device...')
                         try:
-                            self.dispatch(f'/usr/bin/rsync -aHv --delete {local}/ {device}:/ {" ".join(rsync_exclude)}',
-                                          output='both')
-                            self.ui.info('Updating grub in native environment...')
-                            self.dispatch(f'/usr/bin/ssh {device} /usr/sbin/grub-install /dev/sda',
-                                          output='both')
-                            self.dispatch(f'/usr/bin/ssh {device} /usr/sbin/grub-mkconfig -o /boot/grub/grub.cfg',
-                                          output='both')
+                            self.dispatch(f'/bin/ping {device} -c 1',
+                                          output='stderr')
+                            try:
+                                if sync():
+                                    self.ui.info('Updating grub in native environment...')
+                                    self.dispatch(f'/usr/bin/ssh {device} /usr/sbin/grub-install /dev/sda',
+                                                  output='both')
+                                    self.dispatch(f'/usr/bin/ssh {device} /usr/sbin/grub-mkconfig -o /boot/grub/grub.cfg',
+                                                  output='both')
+                            except self.exc_class:
+                                self.ui.warning('Something went wrong during the rsync process...')
                         except self.exc_class:
-                            self.ui.warning('Something went wrong during the rsync process...')
-                    except self.exc_class:
-                        self.ui.warning('Device is offline, changes are NOT synced...')
-            finally:
-                self.dispatch(f'/usr/bin/sleep 0.2 && /bin/umount {local}',
-                              output='stderr')
-        else:
-            self.ui.warning('No other device chroot environment should be open while doing rsync, close them...')
+                            self.ui.warning('Device is offline, changes are NOT synced...')
+                finally:
+                    self.dispatch(f'/usr/bin/sleep 0.2 && /bin/umount {local}',
+                                  output='stderr')
+            else:
+                self.ui.warning('No other device chroot environment should be open while doing rsync, close them...')
 
 if __name__ == '__main__':
     app = admin(job_class=pylon.gentoo.job.job,
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 '''container script for all backup related admin tasks
 '''
+import backup_btrfs
+import contextlib
+import fcntl
 import hashlib
 import os
 import pprint
@@ -9,9 +12,12 @@ import pylon.gentoo.job
 import pylon.gentoo.ui
 import re
 import sys
+import threading
+import time
 
 transfer_engines = (
     'btrfs',
+    'rsync',
     'unison',
     )
 
@@ -32,7 +38,7 @@ tasks = {
         ('diablo',
          '/mnt/work/backup/online/diablo',
          '/mnt/work/backup/online',
-         'btrfs', '10h'),
+         'btrfs', '10hc'), # c: skip snapshots while source is unchanged
         ('diablo_offline',
          '/mnt/work/backup/online/diablo',
          '/mnt/work/backup/offline',
@@ -45,12 +51,29 @@ tasks = {
          '/run/media/schweizer/external',
          'btrfs', 'a15y4'), # add hour interval to allow easy manual refresh at any time
 
+        # non-btrfs usb disk, hard-linked snapshots
+        #('diablo_usb',
+        # '/mnt/work/backup/online/diablo',
+        # '/run/media/schweizer/usb',
+        # 'rsync', '7d6m --exclude=/var/cache'),
+
         #('/mnt/video/',
         # '/tmp/backup/video/unison/',
-        # 'unison', '-batch -ignore "Path movies" -ignore "Path 0_sort"'),
+        # 'unison', '-batch -split 4 -ignore "Path movies" -ignore "Path 0_sort"'), # top-level dirs as parallel roots
     ),
 }
 
+# - tasks reading from a device written by a preceding task are inferred to depend on it
+# - additional dependencies can be declared per task id
+task_deps = {
+}
+
+# flock files of running tasks
+lock_dir = '/run/lock'
+
+# maximum number of concurrently running tasks per device
+device_jobs = 1
+
 class ui(pylon.gentoo.ui.ui):
     def __init__(self, owner):
         super().__init__(owner)
@@ -59,7 +82,15 @@ class ui(pylon.gentoo.ui.ui):
                                         help='use a specific backup engine')
         self.parser_common.add_argument('-t','--task',
                                         help='do not loop all tasks, specify regex of backup task ids')
+        self.parser_common.add_argument('-w','--wait', nargs='?', const=0, type=int,
+                                        help='queue behind running task instead of failing, optional timeout in seconds')
         self.init_op_parser()
+        self.parser_exec.add_argument('-c','--cleaner', action='store_true',
+                                      help='wait for btrfs cleaner after deleting snapshots')
+        self.parser_exec.add_argument('-s','--spool',
+                                      help='spool btrfs send streams to local directory, failed receives are retried from there')
+        self.parser_exec.add_argument('-r','--repeat', action='store_true',
+                                      help='keep unison tasks running and synchronize changes as they happen (combine with -e unison)')
         self.parser_modify.add_argument('-o','--options',
                                         help='pass custom string to backup module')
 
@@ -84,22 +115,74 @@ class backup(pylon.base.base):
 
     def do(self, task, src_path, dest_path, opts, command):
 
-        # lock backup dest to prevent overlapping backup
-        lock_path = '/tmp/' + self.__class__.__name__ + hashlib.md5(task.encode('utf-8')).hexdigest()
-        try:
-            os.makedirs(lock_path)
-        except OSError:
-            raise self.exc_class('backup task {0} is already locked'.format(task))
+        # - lock backup task to prevent overlapping backup
+        # - flock is released by the kernel when a process dies, crashed runs cannot block future runs
+        with self.open_lock(task) as lock:
+            self.lock(task, lock)
+            try:
+                command(task, src_path, dest_path, opts)
+            finally:
+                # empty lock file marks a clean release
+                lock.truncate(0)
 
-        # remove lock dir in every case
+    def do_group(self, group, members, command):
+
+        # locked tasks are left out, the remaining ones of the group are processed anyway
+        locked = list()
+        with contextlib.ExitStack() as stack:
+            for (task, src_path, dest_path, opts) in group:
+                try:
+                    lock = stack.enter_context(self.open_lock(task))
+                    self.lock(task, lock)
+                except self.exc_class as e:
+                    self.ui.error(str(e))
+                    continue
+                stack.callback(lock.truncate, 0)
+                locked.append((task, src_path, dest_path, opts))
+            if locked:
+                command(locked, members)
+        if len(locked) < len(group):
+            raise self.exc_class('backup tasks of group {0} are locked'.format(', '.join(x[0] for x in group)))
+
+    def open_lock(self, task):
+        # - lock files live in root-owned /run/lock instead of world-writable /tmp
+        # - planted symlinks are refused, writing the owner would clobber their target
+        path = os.path.join(lock_dir, self.__class__.__name__ + hashlib.md5(task.encode('utf-8')).hexdigest() + '.lock')
         try:
-            command(task, src_path, dest_path, opts)
-        finally:
-            os.rmdir(lock_path)
+            fd = os.open(path, os.O_CREAT | os.O_RDWR | os.O_APPEND | os.O_NOFOLLOW, 0o644)
+        except OSError as e:
+            raise self.exc_class('cannot open lock file of backup task {0}: {1}'.format(task, e))
+        return os.fdopen(fd, 'a+')
+
+    def lock(self, task, lock):
+        start = time.time()
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                lock.seek(0)
+                owner = lock.read().strip()
+                if self.ui.args.wait is None:
+                    raise self.exc_class('backup task {0} is already locked ({1})'.format(task, owner))
+                if self.ui.args.wait and time.time() - start > self.ui.args.wait:
+                    raise self.exc_class('timeout waiting for backup task {0} ({1})'.format(task, owner))
+                if time.time() - start < 5:
+                    self.ui.info('Waiting for backup task {0} ({1})...'.format(task, owner))
+                time.sleep(5)
+
+        lock.seek(0)
+        owner = lock.read().strip()
+        if owner:
+            self.ui.warning('Taking over stale lock of backup task {0} ({1})'.format(task, owner))
+        lock.truncate(0)
+        lock.write('pid {0} started {1}'.format(os.getpid(), time.strftime('%Y-%m-%d %H:%M:%S')))
+        lock.flush()
 
     def do_loop(self, command, blocking):
-        for (task, src_path, dest_path, engine, opts) in tasks[self.ui.hostname]:
-            if (self.selected(engine, task)):
+        selected = [x for x in tasks[self.ui.hostname] if self.selected(x[3], x[0])]
+        if blocking:
+            for (task, src_path, dest_path, engine, opts) in selected:
                 self.dispatch(self.do,
                               blocking=blocking,
                               task=task,
@@ -107,6 +190,78 @@ class backup(pylon.base.base):
                               dest_path=dest_path,
                               opts=opts,
                               command=getattr(getattr(self, engine), command))
+            return
+
+        # - tasks sharing a source are run as one unit if the engine supports groups, eg. single btrfs send for several receivers
+        # - tasks writing to their source device (eg. hourly snapshots) run on their own, long clones must not lock them
+        # - group members are all configured tasks of that source, also the ones not selected
+        devs = {x[0]: (self.get_dev(x[1]), self.get_dev(x[2])) for x in tasks[self.ui.hostname]}
+        units = dict()
+        for x in selected:
+            grouped = hasattr(getattr(self, x[3]), command + '_group') and devs[x[0]][0] != devs[x[0]][1]
+            key = (x[3], x[1]) if grouped else x[0]
+            units.setdefault(key, list()).append(x)
+
+        # schedule units as DAG
+        # - eg. hourly online snapshot needs to finish before cloning it to offline/external
+        # - tasks sharing a device are limited by device_jobs, avoids contended source reads
+        done = {x[0]: threading.Event() for x in selected}
+        slots = {dev: threading.BoundedSemaphore(device_jobs) for x in devs.values() for dev in x}
+        scheduled = list()
+        for key, unit in units.items():
+            names = [x[0] for x in unit]
+            src_devs = [devs[x][0] for x in names]
+            deps = [x for x in scheduled if devs[x][1] in src_devs]
+            deps += [x for name in names for x in task_deps.get(name, ()) if x in done and x not in deps + names]
+            if deps:
+                self.ui.debug('{0} depends on {1}'.format(', '.join(names), ', '.join(deps)))
+            scheduled += names
+
+            (task, src_path, dest_path, engine, opts) = unit[0]
+            if isinstance(key, tuple):
+                kwargs = dict(runner=self.do_group,
+                              group=[(x[0], x[1], x[2], x[4]) for x in unit],
+                              members=[x[0] for x in tasks[self.ui.hostname]
+                                       if x[3] == engine and x[1] == src_path and devs[x[0]][0] != devs[x[0]][1]],
+                              command=getattr(getattr(self, engine), command + '_group'))
+            else:
+                kwargs = dict(runner=self.do,
+                              task=task,
+                              src_path=src_path,
+                              dest_path=dest_path,
+                              opts=opts,
+                              command=getattr(getattr(self, engine), command))
+            self.dispatch(self.do_scheduled,
+                          blocking=False,
+                          deps=[done[x] for x in deps],
+                          slots=[slots[x] for x in sorted(set(dev for name in names for dev in devs[name]), key=str)],
+                          done=[done[x] for x in names],
+                          **kwargs)
+
+    def do_scheduled(self, deps, slots, done, runner, **kwargs):
+        try:
+            for dep in deps:
+                dep.wait()
+            # device slots are always acquired in the same order to avoid deadlocks
+            for slot in slots:
+                slot.acquire()
+            try:
+                runner(**kwargs)
+            finally:
+                for slot in reversed(slots):
+                    slot.release()
+        finally:
+            # dependent tasks are started even after failures, existing snapshots can still be processed
+            for x in done:
+                x.set()
+
+    @staticmethod
+    def get_dev(path):
+        # - st_dev differs for every btrfs subvolume, so use the source device of the enclosing mount
+        # - unavailable paths (eg. unmounted external disk) never share a device
+        if not os.path.exists(path):
+            return os.path.realpath(path)
+        return backup_btrfs.get_mount(path).source
             
     def selected(self, engine, task):
         return ((not self.ui.args.engine or self.ui.args.engine == engine) and
@@ -6,6 +6,8 @@ NOTES
  - if  newest timedelta slot contains 0 timestamps => take snapshot
  - if !oldest timedelta slot contains more than 1 timestamp => keep oldest, delete others
  - if  oldest timedelta slot contains more than 1 timestamp => keep newest, delete others
+ - interval string flag c: if the source is unchanged since the latest snapshot, the newest timedelta slot counts
+   as covered and no snapshot is taken (eg. hourly snapshots over night)
  - if no timedeltas are specified, all new snapshots from src are cloned to dest, obsolete ones in dest are deleted
  - deleting snapshot will always happen together with creating snapshots, since older deltas are always >= newer deltas 
  - the single snapshot after the oldest timedelta is kept for/replaced after oldest-1 timedelta
@@ -15,38 +17,213 @@ NOTES
  - Remote backup with send/receive are faster than simple rsync
  - source snapshot paths must always be specified as absolute paths from root, not path to mount point,
    or otherwise the automatic extraction of incremental snapshot directory fails
-  
-FIXME
- - now using -p instead of -c to support correct parent lookup when restarting backup flow after restore
-   there should only ever be one reference for not same_fs case, right?
- - automatic creation of diablo link to latest (writeable) backup snapshot on offline/external array
- - try to stretch timeline, so to avoid deleting many interesting snapshot increments when booting up after a long downtime
-   - if !newest timedelta slot contains 0 timestamps => shift ts_now slightly before next ts found in ts_recv_list
- - implement unittest as __main__ instead of commented code
-   - create dummy subvols on recv side based on timedelta log curve
-     - create holes in log curve (longer downtime)
-   - map different timedelta configs on log curve created on recv side
-     - does td resolution changes work as expected?
-   - interrupt send/receive and verify cleanup is working during next startup (writeable snapshot deleted?)
- - implement info() to get actual disk space of snapshots (using btrfs qgroups)
+ - clone tasks of the same source share reference snapshots (<source>_ref.<ts>) on src, receivers needing the
+   same snapshot & parent are fed by a single btrfs send. received snapshots are renamed after the task.
+   references named after the task (older layout) are still used as parents until superseded
+ - with --spool, send streams are written to a local spool with per-chunk checksums before receiving. receives
+   failing (eg. unplugged external) are retried from the spool, also by later runs, without reading the source again
+ - retention planning is free of side effects, replay years of hourly runs incl. downtimes with
+   backup_btrfs.py [interval ...]
+ - info() reports qgroup sizes of snapshots (needs quotas enabled)
    determining the sizes of specific snapshots (via quota & qgroup) is usually meaningless. deleting snapshots from within the
    timedelta grid simply shifts shared data to the neighboring snapshots. reduction in size can only be reached by simply
    deleting the oldest snapshots (which can easily done manually without any adm_backup operation).
    it would only make sense for snapshots which show a large "exclusive size" (3rd column in qgroup output), which can be elevated
    for snapshots containing many large transient files (downloads, caches, ...), but it's generally better to decrease
    snapshot retention time in this case
+  
+FIXME
+ - now using -p instead of -c to support correct parent lookup when restarting backup flow after restore
+   the parent is picked by uuid lineage (nearest by generation) from a cached subvolume catalog
+ - automatic creation of diablo link to latest (writeable) backup snapshot on offline/external array
+ - try to stretch timeline, so to avoid deleting many interesting snapshot increments when booting up after a long downtime
+   - if !newest timedelta slot contains 0 timestamps => shift ts_now slightly before next ts found in ts_recv_list
+ - interrupt send/receive and verify cleanup is working during next startup (writeable snapshot deleted?)
 '''
+import bisect
+import collections
 import datetime
+import fcntl
 import glob
+import hashlib
+import json
 import os
 import pylon.base
+import queue
 import re
+import struct
+import subprocess
 import sys
 import threading
+import time
+import types
+import uuid
 
 snapshot_pattern = '%Y-%m-%dT%H-%M-%S'
 snapshot_regex = '[0-9]*-[0-9]*-[0-9]*T[0-9]*-[0-9]*-[0-9]*'
 
+# linux/btrfs.h
+BTRFS_IOC_SUBVOL_GETFLAGS = 0x80089419 # _IOR(0x94, 25, __u64)
+BTRFS_IOC_FS_INFO = 0x8400941f # _IOR(0x94, 31, struct btrfs_ioctl_fs_info_args)
+BTRFS_IOC_GET_SUBVOL_INFO = 0x81f8943c # _IOR(0x94, 60, struct btrfs_ioctl_get_subvol_info_args)
+BTRFS_SUBVOL_RDONLY = 1 << 1
+BTRFS_FS_INFO_FLAG_GENERATION = 1 << 1
+
+# fs/btrfs/send.h
+BTRFS_SEND_C_UPDATE_EXTENT = 22
+BTRFS_SEND_A_SIZE = 4
+
+# - clone tasks of a source share reference snapshots on src, named after the source subvolume
+# - send streams are teed to receivers in chunks, queue depth bounds memory per receiver
+ref_suffix = '_ref'
+stream_chunk = 1024**2
+stream_queue = 16
+spool_tries = 3
+
+# subvolume catalogs per filesystem & transfer history, kept between runs
+cache_dir = '/var/cache/backup'
+history_file = 'btrfs_history.jsonl'
+
+# number of oldest snapshots the freed space is projected for
+info_oldest = 5
+
+# filesystem uuids per st_dev, stable for the life of the process
+fs_uuids = dict()
+
+def estimate_stream(chunks):
+    # - sizes of a send stream generated with --no-data, write commands are replaced by update_extent
+    #   commands carrying only the size of the extent
+    # - returns metadata stream size & data size
+    buf = bytearray()
+    meta = data = 0
+    pos = 17 # struct btrfs_stream_header
+    for chunk in chunks:
+        meta += len(chunk)
+        buf += chunk
+        # struct btrfs_cmd_header: len, cmd, crc followed by tlv attributes
+        while len(buf) - pos >= 10:
+            length, cmd = struct.unpack_from('<IH', buf, pos)
+            if len(buf) - pos < 10 + length:
+                break
+            if cmd == BTRFS_SEND_C_UPDATE_EXTENT:
+                tlv = pos + 10
+                while tlv < pos + 10 + length:
+                    attr, attr_len = struct.unpack_from('<HH', buf, tlv)
+                    if attr == BTRFS_SEND_A_SIZE:
+                        data += struct.unpack_from('<Q', buf, tlv + 4)[0]
+                    tlv += 4 + attr_len
+            pos += 10 + length
+        cut = min(pos, len(buf))
+        del buf[:cut]
+        pos -= cut
+    return meta, data
+
+mount_info = collections.namedtuple('mount_info', 'point root fstype source')
+
+def get_mount(path):
+    # - enclosing mount of path: mount point, mounted root within its filesystem, fs type & mount source
+    # - octal escapes of mountinfo (eg. \040 for spaces) are decoded
+    path = os.path.realpath(path)
+    mounts = dict()
+    with open('/proc/self/mountinfo', 'r') as f:
+        for l in f:
+            fields = l.split()
+            sep = fields.index('-')
+            (point, root, fstype, source) = (re.sub(r'\\([0-7]{3})', lambda x: chr(int(x.group(1), 8)), x)
+                                             for x in (fields[4], fields[3], fields[sep + 1], fields[sep + 2]))
+            mounts[point] = mount_info(point, root, fstype, source)
+    return mounts[max((x for x in mounts if path == x or path.startswith(x.rstrip('/') + '/')), key=len)]
+
+plan_result = collections.namedtuple('plan_result', 'snapshot clone delete_ref delete keep')
+
+def plan(ts_now, td_list, ts_send_list, ts_recv_list, same_fs, covered=False):
+    # - timedelta window idx covers ]ts_now - td_list[idx], ts_now - td_list[idx-1][
+    # - covered: newest window counts as covered without a snapshot, eg. source unchanged since latest snapshot
+    # - windows are assigned via bisect over sorted timestamps instead of checking every timestamp against every window
+    bounds = [ts_now] + [ts_now - td for td in td_list]
+    def window(ts_list, idx):
+        return ts_list[bisect.bisect_right(ts_list, bounds[idx+1]):bisect.bisect_left(ts_list, bounds[idx])]
+
+    ts_send_list = sorted(ts_send_list)
+    ts_recv_list = sorted(ts_recv_list)
+
+    # the newest timedelta window starts at now - 0
+    snapshot = not covered and not window(ts_recv_list, 0)
+
+    clone = list()
+    delete_ref = list()
+    if not same_fs:
+        if snapshot:
+            ts_send_list.append(ts_now)
+        # clone all new timestamps, afterwards only the newest reference needs to be kept on src
+        ts_of_clones = sorted(set(ts_send_list) & set(ts_recv_list))
+        clone = sorted(set(ts_send_list) - set(ts_recv_list))
+        delete_ref = (ts_of_clones + clone)[:-1]
+        ts_recv_list = sorted(ts_recv_list + clone)
+    elif snapshot:
+        ts_recv_list.append(ts_now)
+
+    delete = list()
+    for idx in range(len(td_list)):
+        ts_within_td = window(ts_recv_list, idx)
+        if idx == 0 and snapshot:
+            ts_within_td.append(ts_now)
+
+        # keep only the newest snapshot in the oldest timedelta window
+        if (idx == len(td_list) - 1 or
+
+            # - we need to keep newest snapshot in newest timedelta for
+            #   incremental send/receive case
+            # - a reference snapshot on src is only available for the newest timedelta
+            # - this condition surfaces when going from small to large timedelta resolution
+            idx == 0 and not same_fs):
+            delete += ts_within_td[:-1]
+
+        # keep only a single (the oldest) snapshot within any given timedelta
+        else:
+            delete += ts_within_td[1:]
+
+    return plan_result(snapshot=snapshot,
+                       clone=clone,
+                       delete_ref=delete_ref,
+                       delete=sorted(delete),
+                       keep=sorted(set(ts_recv_list) - set(delete)))
+
+def window_counts(ts_now, td_list, ts_list):
+    # number of timestamps per timedelta window, ts_list needs to be sorted
+    bounds = [ts_now] + [ts_now - td for td in td_list]
+    return [bisect.bisect_left(ts_list, bounds[idx]) - bisect.bisect_right(ts_list, bounds[idx+1])
+            for idx in range(len(td_list))]
+
+def append_history(history, task, ts_now, entry):
+    # transfer history, one json line per run in an engine specific file below cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, history), 'a') as f:
+        f.write(json.dumps(dict(task=task, ts=ts_now.strftime(snapshot_pattern), **entry)) + '\n')
+
+def summarize_history(history, task):
+    # report lines of the transfer history of a task
+    try:
+        with open(os.path.join(cache_dir, history), 'r') as f:
+            runs = [x for x in (json.loads(l) for l in f) if x['task'] == task]
+    except OSError:
+        return list()
+    if not runs:
+        return list()
+    rates = sorted(x['bytes'] / 1e6 / max(x['seconds'], 1e-3) for x in runs)
+    last = runs[-1]
+    return ['{0}: {1} transfers, {2:.1f} GiB total, median {3:.1f} MB/s'.format(task,
+                                                                            len(runs),
+                                                                            sum(x['bytes'] for x in runs) / 1024**3,
+                                                                            rates[len(rates) // 2]),
+            '{0}: last {1}, {2:.1f} MiB{3} in {4:.0f}s{5}'.format(task,
+                                                               last['ts'],
+                                                               last['bytes'] / 1024**2,
+                                                               ' ({0} files)'.format(last['files']) if 'files' in last else '',
+                                                               last['seconds'],
+                                                               ', estimated {0:.1f} MiB'.format(last['estimate'] / 1024**2)
+                                                               if last.get('estimate') else '')]
+
 class backup_btrfs(pylon.base.base):
     __doc__ = sys.modules[__name__].__doc__
     
@@ -62,7 +239,8 @@ class backup_btrfs(pylon.base.base):
     def get_ts_now():
         return datetime.datetime.today().replace(microsecond=0)
     
-    def get_td(self, delta_str):
+    @classmethod
+    def get_td(cls, delta_str, ts_now=None):
         # take a snapshot every time
         if 'a' in delta_str:
             yield datetime.timedelta(seconds=1)
@@ -91,7 +269,7 @@ class backup_btrfs(pylon.base.base):
 
         # - append delta to max past, to facilitate keeping 1 snapshot after last configured delta
         # - subtract 1 min to avoid datetime overflows in window calculations
-        yield self.get_ts_now() - datetime.datetime.min - datetime.timedelta(minutes=1)
+        yield (ts_now or cls.get_ts_now()) - datetime.datetime.min - datetime.timedelta(minutes=1)
 
     def get_ts(self, path):
         for d in glob.glob(path):
@@ -100,18 +278,287 @@ class backup_btrfs(pylon.base.base):
             except Exception:
                 self.ui.warning('Failed to extract ts: ' + d)
 
-    def get_btrfs_uuid(self, path):
-        # 'filesystem show' is not stable, sometimes it just bails out without any output
-        while True:
-            output = self.dispatch('/sbin/btrfs filesystem show {0}'.format(path),
+    def dispatch_stable(self, cmd, tries=5):
+        # some btrfs commands are not stable, sometimes they just bail out without any output
+        for attempt in range(tries):
+            output = self.dispatch(cmd,
                                    passive=True,
                                    output=None).stdout
+            if output:
+                return output
+            time.sleep(0.1 * 2**attempt)
+        raise self.exc_class('no output after {0} tries: {1}'.format(tries, cmd))
+
+    def get_btrfs_uuid(self, path):
+        # missing paths (eg. unplugged external disk) fail the task, not the whole run
+        try:
+            dev = os.stat(path).st_dev
+        except OSError as e:
+            raise self.exc_class('{0} is not available: {1}'.format(path, e.strerror))
+        if dev not in fs_uuids:
+            # fsid follows max_id & num_devices in struct btrfs_ioctl_fs_info_args
             try:
-                return re.search('uuid: (.*)', output[0]).group(1)
-            except Exception:
-                pass
+                fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    fs_info = fcntl.ioctl(fd, BTRFS_IOC_FS_INFO, bytes(1024))
+                finally:
+                    os.close(fd)
+                fs_uuids[dev] = str(uuid.UUID(bytes=fs_info[16:32]))
+            except OSError:
+                match = re.search('uuid: (.*)', self.dispatch_stable('/sbin/btrfs filesystem show {0}'.format(path))[0])
+                if not match:
+                    raise self.exc_class('{0} is not on a btrfs filesystem'.format(path))
+                fs_uuids[dev] = match.group(1)
+        return fs_uuids[dev]
+
+    def get_ctransid(self, path):
+        # transid of the last change within a subvolume, snapshots inherit it from their source
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                subvol_info = fcntl.ioctl(fd, BTRFS_IOC_GET_SUBVOL_INFO, bytes(504))
+            finally:
+                os.close(fd)
+        except OSError:
+            return None
+        return struct.unpack_from('=Q', subvol_info, 344)[0]
+
+    def unchanged(self, t, snap_path):
+        # - optional per task, source without changes since the given snapshot needs no new one
+        # - unknown transids (kernels before 4.18) always count as changed
+        if not t.changes_only:
+            return False
+        ctransid = self.get_ctransid(t.src_path)
+        if ctransid is None or ctransid != self.get_ctransid(snap_path):
+            return False
+        self.ui.info('Skipping snapshot, {0} unchanged since {1}'.format(t.src_path, snap_path))
+        return True
+
+    def get_ro(self, path):
+        # query subvolume flags in-process instead of spawning 'btrfs property get' per snapshot
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                flags = struct.unpack('=Q', fcntl.ioctl(fd, BTRFS_IOC_SUBVOL_GETFLAGS, bytes(8)))[0]
+            finally:
+                os.close(fd)
+            return bool(flags & BTRFS_SUBVOL_RDONLY)
+        except OSError:
+            return 'true' in self.dispatch_stable('/sbin/btrfs property get {0} ro'.format(path))[0]
            
-    def do(self, task, src_path, dest_path, opts=''):
+    def delete_subvolumes(self, paths):
+        # - one process & a single transaction commit for all paths instead of a commit per subvolume
+        # - background cleaner frees the space afterwards, optionally wait for it
+        if not paths:
+            return
+        start = time.time()
+        self.dispatch('/sbin/btrfs subvolume delete -c ' + ' '.join(paths),
+                      output='stderr')
+        if getattr(self.ui.args, 'cleaner', False):
+            for d in sorted(set(os.path.dirname(x) for x in paths)):
+                self.ui.info('Waiting for btrfs cleaner on {0}...'.format(d))
+                self.dispatch('/sbin/btrfs subvolume sync ' + d,
+                              output='stderr')
+        self.ui.info('Deleted {0} subvolumes in {1:.1f}s'.format(len(paths), time.time() - start))
+
+    def read_stream(self, cmd):
+        # a failing sender must never look like a regular end of stream to receivers
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        try:
+            for chunk in iter(lambda: proc.stdout.read(stream_chunk), b''):
+                yield chunk
+        except GeneratorExit:
+            proc.kill()
+            proc.wait()
+            raise
+        if proc.wait():
+            raise self.exc_class('{0} failed with exit status {1}'.format(' '.join(cmd), proc.returncode))
+
+    def tee(self, chunks, recv_dirs):
+        # - bounded queue per receiver, the slowest receiver throttles the reader instead of piling up the stream in memory
+        # - incomplete streams kill all receivers, nothing gets finalized on the receiving side
+        # - returns receiving dirs which failed
+        recvs = {d: (subprocess.Popen(['/usr/bin/ionice', '-c3', '/sbin/btrfs', 'receive', d],
+                                      stdin=subprocess.PIPE),
+                     queue.Queue(stream_queue)) for d in recv_dirs}
+        failed = set()
+
+        def feed(d, recv, q):
+            # a dead receiver keeps draining its queue, the others continue
+            for chunk in iter(q.get, None):
+                if d not in failed:
+                    try:
+                        recv.stdin.write(chunk)
+                    except BrokenPipeError:
+                        failed.add(d)
+            try:
+                recv.stdin.close()
+            except BrokenPipeError:
+                failed.add(d)
+
+        feeders = [threading.Thread(target=feed, args=(d,) + x) for d, x in recvs.items()]
+        for x in feeders:
+            x.start()
+        try:
+            for chunk in chunks:
+                if len(failed) == len(recvs):
+                    chunks.close()
+                    break
+                for recv, q in recvs.values():
+                    q.put(chunk)
+        except BaseException:
+            for recv, q in recvs.values():
+                recv.kill()
+            raise
+        finally:
+            for recv, q in recvs.values():
+                q.put(None)
+            for x in feeders:
+                x.join()
+            failed.update(d for d, (recv, q) in recvs.items() if recv.wait())
+        return failed
+
+    def estimate(self, send_cmd):
+        # metadata only pass over the increment, data sizes are taken from the stream
+        try:
+            meta, data = estimate_stream(self.read_stream(send_cmd[:-1] + ['--no-data'] + send_cmd[-1:]))
+        except (self.exc_class, struct.error) as e:
+            self.ui.warning('Estimation failed: ' + str(e))
+            return None
+        self.ui.info('Estimated {0:.1f} MiB ({1:.1f} MiB metadata)'.format((meta + data) / 1024**2, meta / 1024**2))
+        return meta + data
+
+    def meter(self, chunks, stats):
+        # pass-through byte counter, progress is reported against the estimate
+        stats['bytes'] = 0
+        start = last = time.time()
+        try:
+            for chunk in chunks:
+                stats['bytes'] += len(chunk)
+                if time.time() - last > 60:
+                    last = time.time()
+                    self.ui.info('{0:.1f} MiB transferred{1}...'.format(stats['bytes'] / 1024**2,
+                                                                         ' ({0:.0f}%)'.format(100 * stats['bytes'] / stats['estimate'])
+                                                                         if stats.get('estimate') else ''))
+                yield chunk
+        finally:
+            chunks.close()
+            stats['seconds'] = time.time() - start
+        self.ui.info('Transferred {0:.1f} MiB in {1:.0f}s ({2:.1f} MB/s)'.format(stats['bytes'] / 1024**2,
+                                                                               stats['seconds'],
+                                                                               stats['bytes'] / 1e6 / max(stats['seconds'], 1e-3)))
+
+    def record(self, task, stats):
+        # transfer history, summarized by info
+        if 'seconds' not in stats:
+            return
+        append_history(history_file, task, self.get_ts_now(), {'bytes': stats['bytes'],
+                                                               'seconds': round(stats['seconds'], 1),
+                                                               'estimate': stats.get('estimate')})
+
+    def send_receive(self, snap_path, parent_path, recv_dirs, stats):
+        # - a single btrfs send is read once and teed to all receivers
+        # - optionally the stream is spooled to a local file first, failed receives are retried from there
+        # - returns receiving dirs which failed, bytes & duration of the transfer are filled into stats
+        self.ui.info('Cloning {0} to {1}...'.format(snap_path, ', '.join(recv_dirs)))
+        if self.ui.args.dry_run:
+            return set()
+        send_cmd = (['/usr/bin/ionice', '-c3', '/sbin/btrfs', 'send', '-q'] +
+                    (['-p', parent_path] if parent_path else []) + [snap_path])
+        stats['estimate'] = self.estimate(send_cmd)
+        if getattr(self.ui.args, 'spool', None):
+            spool_path = self.spool(send_cmd, snap_path, parent_path)
+            if spool_path:
+                return self.receive_spool(spool_path, recv_dirs, stats)
+            self.ui.warning('Spooling failed, sending directly')
+        try:
+            return self.tee(self.meter(self.read_stream(send_cmd), stats), recv_dirs)
+        except self.exc_class as e:
+            self.ui.error(str(e))
+            return set(recv_dirs)
+
+    def spool(self, send_cmd, snap_path, parent_path):
+        # - stream is written with a sha256 per chunk, the json file is written last and marks a complete spool
+        # - returns spool path without extension
+        spool_path = os.path.join(self.ui.args.spool,
+                                  os.path.basename(snap_path) + '.' + (os.path.basename(parent_path) if parent_path else 'full'))
+        self.ui.info('Spooling to {0}...'.format(spool_path))
+        sums = list()
+        try:
+            with open(spool_path + '.stream', 'wb') as f:
+                for chunk in self.read_stream(send_cmd):
+                    f.write(chunk)
+                    sums.append(hashlib.sha256(chunk).hexdigest())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(spool_path + '.tmp', 'w') as f:
+                json.dump({'snapshot': snap_path, 'parent': parent_path, 'sums': sums}, f)
+            os.replace(spool_path + '.tmp', spool_path + '.json')
+        except (self.exc_class, OSError) as e:
+            self.ui.error(str(e))
+            self.remove_spool(spool_path)
+            return None
+        return spool_path
+
+    def read_spool(self, spool_path):
+        with open(spool_path + '.json', 'r') as f:
+            sums = json.load(f)['sums']
+        with open(spool_path + '.stream', 'rb') as f:
+            for idx, digest in enumerate(sums):
+                chunk = f.read(stream_chunk)
+                if hashlib.sha256(chunk).hexdigest() != digest:
+                    raise self.exc_class('corrupt chunk {0} in spool {1}'.format(idx, spool_path))
+                yield chunk
+            if f.read(1):
+                raise self.exc_class('trailing data in spool {0}'.format(spool_path))
+
+    def receive_spool(self, spool_path, recv_dirs, stats):
+        # - receives are verified by their read-only flag, btrfs receive sets it after the last command of the stream
+        # - failed receives are retried, unavailable receivers (eg. unplugged external) are left for later runs
+        # - spool is removed once all receives are verified, otherwise kept for later runs
+        if self.ui.args.dry_run:
+            return set()
+        with open(spool_path + '.json', 'r') as f:
+            recv_name = os.path.basename(json.load(f)['snapshot'])
+        failed = set(recv_dirs)
+        for attempt in range(spool_tries):
+            todo = sorted(d for d in failed if os.path.isdir(d))
+            if not todo:
+                break
+            if attempt:
+                self.ui.warning('Retrying receive from {0} to {1}...'.format(spool_path, ', '.join(todo)))
+            # partial receives of previous attempts
+            self.delete_subvolumes([os.path.join(d, recv_name) for d in todo
+                                    if os.path.exists(os.path.join(d, recv_name))])
+            try:
+                errors = self.tee(self.meter(self.read_spool(spool_path), stats), todo)
+            except self.exc_class as e:
+                # corrupt spool, next run sends from the source again
+                self.ui.error(str(e))
+                self.remove_spool(spool_path)
+                return failed
+            failed -= set(todo) - errors
+            failed.update(d for d in todo if d not in failed and not self.get_ro(os.path.join(d, recv_name)))
+        if not failed:
+            self.remove_spool(spool_path)
+        return failed
+
+    def remove_spool(self, spool_path):
+        for ext in ('.json', '.tmp', '.stream'):
+            if os.path.exists(spool_path + ext):
+                os.remove(spool_path + ext)
+
+    def get_spools(self, ref_name):
+        # complete spools of a source, left behind by failed receives
+        if not getattr(self.ui.args, 'spool', None):
+            return dict()
+        spools = dict()
+        for path in glob.glob(os.path.join(self.ui.args.spool, ref_name + '.*.json')):
+            with open(path, 'r') as f:
+                spools[path[:-len('.json')]] = json.load(f)
+        return spools
+
+    def prepare(self, task, src_path, dest_path, opts, ts_now):
         
         self.ui.info('Processing {0}...'.format(task))
 
@@ -121,200 +568,424 @@ class backup_btrfs(pylon.base.base):
                           passive=True, output=None)
         except self.exc_class:
             raise self.exc_class('source {0} needs to be a valid btrfs subvolume'.format(src_path))
-        
-        send_dir = os.path.dirname(src_path)
-        recv_dir = dest_path
+
+        t = types.SimpleNamespace(task=task,
+                                  src_path=src_path,
+                                  send_dir=os.path.dirname(src_path),
+                                  recv_dir=dest_path,
+                                  ref_name=os.path.basename(src_path) + ref_suffix)
 
         # determine if we're about to send snapshots between two btrfs instances
-        same_fs = self.get_btrfs_uuid(send_dir) == self.get_btrfs_uuid(recv_dir)
+        t.same_fs = self.get_btrfs_uuid(t.send_dir) == self.get_btrfs_uuid(t.recv_dir)
+        t.td_list = list(self.get_td(opts, ts_now))
+        t.changes_only = 'c' in opts
+
+        writable = list()
+        if not t.same_fs:
+            # received snapshots are renamed after the task, leftovers stem from interrupted runs
+            for ts in self.get_ts(os.path.join(t.recv_dir, t.ref_name + '.*')):
+                path = self.get_path_of_ts(t.recv_dir, t.ref_name, ts)
+                if self.get_ro(path):
+                    self.ui.warning('Renaming received snapshot: ' + path)
+                    if not self.ui.args.dry_run:
+                        os.rename(path, self.get_path_of_ts(t.recv_dir, task, ts))
+                else:
+                    self.ui.warning('Deleting writable clone: ' + path)
+                    writable.append(path)
+        t.ts_recv_list = sorted(self.get_ts(os.path.join(t.recv_dir, task + '.*')))
 
-        ts_now = self.get_ts_now()
-        td_list = list(self.get_td(opts))
-        
-        send_path = self.get_path_of_ts(send_dir, task, ts_now)
-        recv_path = self.get_path_of_ts(recv_dir, task, ts_now)
-        ts_send_list = sorted(list(self.get_ts(os.path.join(send_dir, task + '.*')))) 
-        ts_recv_list = sorted(list(self.get_ts(os.path.join(recv_dir, task + '.*')))) 
-        
         # - send/receive references must be read-only
         # - writeable clones on receiving side are left behind by interrupted send/receive operation
         # - ensure read-only status of existing snapshots even in same_fs case
-        ts_of_clones = sorted(list(set(ts_send_list) & set(ts_recv_list)))
-        for d in (send_dir, recv_dir):
-            for ts in ts_of_clones:
-                path = self.get_path_of_ts(d, task, ts)
-                # 'property get' is not stable, sometimes it just bails out without any output
-                while True:
-                    try:
-                        ro = 'false' in self.dispatch('/sbin/btrfs property get {0} ro'.format(path),
-                                                      passive=True,
-                                                      output=None).stdout[0]
-                        break
-                    except IndexError:
-                        pass
-                if ro:
-                
-                    self.ui.warning('Deleting writable clone: ' + path)
-                    self.dispatch('/sbin/btrfs subvolume delete -c ' + path,
-                                  output='stderr')
-                    if d is send_dir:
-                        ts_send_list.remove(ts)
-                    else:
-                        ts_recv_list.remove(ts)
-            if same_fs:
-                break
+        for ts in list(t.ts_recv_list):
+            path = self.get_path_of_ts(t.recv_dir, task, ts)
+            if not self.get_ro(path):
+                self.ui.warning('Deleting writable clone: ' + path)
+                writable.append(path)
+                t.ts_recv_list.remove(ts)
+        # need to be gone before receiving the same snapshots again
+        self.delete_subvolumes(writable)
 
-        for idx,td in enumerate(td_list):
+        if not t.same_fs:
+            t.parent = self.get_parent(t.send_dir, t.recv_dir, writable)
+        return t
 
-            # how many snapshots are within the current timedelta window?
-            ts_within_td = list()
+    def get_fs_generation(self, path):
+        # generation is only reported on request, None for kernels before 5.11
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                fs_info = fcntl.ioctl(fd, BTRFS_IOC_FS_INFO,
+                                      struct.pack('=48xQ', BTRFS_FS_INFO_FLAG_GENERATION) + bytes(1024 - 56))
+            finally:
+                os.close(fd)
+        except OSError:
+            return None
+        flags, generation = struct.unpack_from('=QQ', fs_info, 48)
+        return generation if flags & BTRFS_FS_INFO_FLAG_GENERATION else None
 
-            # the newest timedelta window starts at now - 0
-            if idx == 0:
-                td_prev = datetime.timedelta()
-                
-            self.ui.debug('Checking delta: ' + str(td))
-            for ts in ts_recv_list:
-                if (ts_now - td) < ts < (ts_now - td_prev):
-                    ts_within_td.append(ts)
-
-            if idx == 0:
-
-                if not ts_within_td:
-                    snap_path = recv_path if same_fs else send_path
-                    self.ui.info('Taking snapshot {0}...'.format(snap_path))
-                    self.dispatch('/sbin/btrfs subvolume snapshot -r {0} {1}'.format(src_path,
-                                                                                     snap_path),
-                                  output='stderr')
-                    ts_send_list.append(ts_now)
-                    ts_within_td.append(ts_now)
-
-                if not same_fs:
-
-                    ts_of_clones = sorted(list(set(ts_send_list) & set(ts_recv_list)))
-                    ts_to_clone  = sorted(list(set(ts_send_list) - set(ts_recv_list)))
-                    ts_to_delete = sorted(list(set(ts_recv_list) - set(ts_send_list)))
-
-                    # clone all new timestamps
-                    #   btrfs sub send <snap 0>
-                    #   for n=1 to N
-                    #      btrfs sub send -p <snap n-1> <snap n>
-                    #    
-                    #   Or, in any order,
-                    #    
-                    #   btrfs sub send <snap s1>
-                    #   for n=1 to N
-                    #      btrfs sub send -c <snap s1> -c <snap s2> -c <snap s3> ... <snap sn>
-                    #    
-                    #   where each subvolume that's been sent before gets added as a -c to the
-                    #   next send command. This second approach means that all possible
-                    #   reflinks between subvolumes can be captured, but it will send all of
-                    #   the metadata across each time. The first approach may lose some manual
-                    #   reflink efficiency, but is better at sending only the necessary
-                    #   changed metadata.
-                    for ts in ts_to_clone:
-
-                        # assemble string of clones timestamp paths
-                        clone_str = ''
-                        for clone in ts_of_clones:
-                            clone_str += ' -p ' + self.get_path_of_ts(send_dir, task, clone)
-
-                        # transfer reference snapshot and any reflink relations
-                        self.ui.info('Cloning to {0}...'.format(recv_path))
-                        self.dispatch('/usr/bin/ionice -c3 /sbin/btrfs send -q {0} {1} | /usr/bin/ionice -c3 /sbin/btrfs receive {2}'.format(clone_str,
-                                                                                                     self.get_path_of_ts(send_dir, task, ts),
-                                                                                                     recv_dir),
-                                      output='stderr')
-
-                        # add freshly cloned snapshot as new clone
-                        ts_of_clones.append(ts)
-                        # needed for proper timedelta cleanup at end of td loop
-                        ts_recv_list.append(ts)
-
-                    # rescan timedelta (needed since cloning multiple snapshots leads to ignored snapshots in subsequent timedelta cleanup,
-                    # they would be deleted in a run without snapshot taking, but this approach is cleaner)
-                    for ts in ts_recv_list:
-                        if ((ts_now - td) < ts < (ts_now - td_prev) and
-                            ts not in ts_within_td):
-                            ts_within_td.append(ts)
-                    ts_within_td.sort()
-                        
-                    # deleting obsolete reference snapshots on src
-                    for ts in ts_of_clones[:-1]:
-                        path = self.get_path_of_ts(send_dir, task, ts)
-                        self.ui.info('Deleting obsolete reference: ' + path)
-                        self.dispatch('/sbin/btrfs subvolume delete -c ' + path,
-                                      output='stderr')
-
-            # keep only the newest snapshot in the oldest timedelta window
-            if (idx == len(td_list) - 1 or
-                
-                # - we need to keep newest snapshot in newest timedelta for
-                #   incremental send/receive case
-                # - a reference snapshot on src is only available for the newest timedelta
-                # - this condition surfaces when going from small to large timedelta resolution
-                idx == 0 and not same_fs):
-                ts_within_td = reversed(ts_within_td)
-
-            # keep only a single snapshot within any given timedelta
-            for idx,ts in enumerate(ts_within_td):
-                path = self.get_path_of_ts(recv_dir, task, ts)
-                if idx > 0:
-                    self.ui.info('Deleting snapshot: ' + path)
-                    self.dispatch('/sbin/btrfs subvolume delete -c ' + path,
-                                  output='stderr')
+    def cached(self, name, path, build, key=None):
+        # - results per filesystem are cached against a key, unchanged keys are not queried again
+        # - default key is the filesystem generation, meant for idle filesystems (eg. offline/external)
+        fs_uuid = self.get_btrfs_uuid(path)
+        if key is None:
+            key = self.get_fs_generation(path)
+        cache_path = os.path.join(cache_dir, name + '.' + fs_uuid + '.json')
+        try:
+            with open(cache_path, 'r') as f:
+                cache = json.load(f)
+            if not key or cache['key'] != key:
+                raise ValueError
+            return cache['data']
+        except (OSError, ValueError, KeyError):
+            data = build()
+            if key:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(cache_path + '.tmp', 'w') as f:
+                    json.dump({'key': key, 'data': data}, f)
+                os.replace(cache_path + '.tmp', cache_path)
+            return data
+
+    def get_catalog(self, path):
+        # - all subvolumes of a filesystem from a single listing, keyed by absolute path below the mount of path
+        # - only entries within path are kept up to date: the cache is keyed on its mtime, which changes whenever
+        #   a subvolume is created, renamed or deleted there. the generation of a live source moves with every commit
+        def build():
+            subvolumes = dict()
+            for l in self.dispatch('/sbin/btrfs subvolume list -g -q -R -u ' + path,
+                                   passive=True,
+                                   output=None).stdout:
+                match = re.search(r'^ID (\d+) gen (\d+) .*\bparent_uuid\s+(\S+)\s+received_uuid\s+(\S+)\s+uuid\s+(\S+)\s+path (.*)$', l)
+                if match:
+                    subvolumes['/' + match.group(6)] = {
+                        'id': int(match.group(1)),
+                        'generation': int(match.group(2)),
+                        'parent_uuid': None if match.group(3) == '-' else match.group(3),
+                        'received_uuid': None if match.group(4) == '-' else match.group(4),
+                        'uuid': match.group(5),
+                    }
+            return subvolumes
+        path = os.path.realpath(path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError as e:
+            raise self.exc_class('{0} is not available: {1}'.format(path, e.strerror))
+        subvolumes = self.cached('catalog', path, build, [path, mtime])
+
+        # paths within the filesystem are relative to the top-level subvolume
+        (mount_point, mount_root) = get_mount(path)[:2]
+        catalog = dict()
+        for x, info in subvolumes.items():
+            if mount_root == '/':
+                catalog[mount_point.rstrip('/') + x] = info
+            elif x == mount_root:
+                catalog[mount_point] = info
+            elif x.startswith(mount_root + '/'):
+                catalog[mount_point.rstrip('/') + x[len(mount_root):]] = info
+        return catalog
+
+    def get_parent(self, send_dir, recv_dir, exclude=()):
+        # - a subvolume on src can be used as parent if the receiving side holds a subvolume received from it
+        #   or from the same origin, eg. snapshots restored from a backup or renamed ones
+        # - btrfs send identifies a subvolume by its received_uuid if present
+        # - the nearest one by generation yields the smallest increment
+        exclude = set(os.path.realpath(x) for x in exclude)
+        received = set()
+        for path, x in self.get_catalog(recv_dir).items():
+            if os.path.dirname(path) == os.path.realpath(recv_dir) and path not in exclude:
+                received.update(y for y in (x['uuid'], x['received_uuid']) if y)
+        parents = [(x['generation'], os.path.basename(path)) for path, x in self.get_catalog(send_dir).items()
+                   if os.path.dirname(path) == os.path.realpath(send_dir) and path not in exclude and
+                   (x['received_uuid'] or x['uuid']) in received]
+        for generation, name in sorted(parents, reverse=True):
+            path = os.path.join(send_dir, name)
+            if self.get_ro(path):
+                return path
+        return None
+
+    def finish(self, t, todo, obsolete):
+        for ts in todo.delete:
+            path = self.get_path_of_ts(t.recv_dir, t.task, ts)
+            self.ui.info('Deleting snapshot: ' + path)
+            obsolete.append(path)
+        for ts in todo.keep:
+            self.ui.debug('Keeping snapshot: ' + self.get_path_of_ts(t.recv_dir, t.task, ts))
+
+    def do(self, task, src_path, dest_path, opts=''):
+        self.do_group(((task, src_path, dest_path, opts),))
+
+    def do_group(self, group, members=()):
+        # - all tasks of a group share src_path, members lists all configured tasks of that source
+        # - snapshots within the same fs are handled first, eg. hourly online snapshot before cloning to offline/external
+        ts_now = self.get_ts_now()
+        failed = list()
+        clones = list()
+        for (task, src_path, dest_path, opts) in group:
+            try:
+                t = self.prepare(task, src_path, dest_path, opts, ts_now)
+                if t.same_fs:
+                    self.do_snapshots(t, ts_now)
                 else:
-                    self.ui.debug('Keeping snapshot: ' + path)
+                    clones.append(t)
+            except (self.exc_class, OSError) as e:
+                self.ui.error(str(e))
+                failed.append(task)
+        if clones:
+            try:
+                failed += self.do_clones(clones, ts_now, members)
+            except self.exc_class as e:
+                self.ui.error(str(e))
+                failed += [t.task for t in clones]
+        if failed:
+            raise self.exc_class('failed backup tasks: ' + ', '.join(failed))
 
-            td_prev = td
+    def do_snapshots(self, t, ts_now):
+        covered = bool(t.ts_recv_list) and self.unchanged(t, self.get_path_of_ts(t.recv_dir, t.task, t.ts_recv_list[-1]))
+        todo = plan(ts_now, t.td_list, t.ts_recv_list, t.ts_recv_list, True, covered)
+        if todo.snapshot:
+            snap_path = self.get_path_of_ts(t.recv_dir, t.task, ts_now)
+            self.ui.info('Taking snapshot {0}...'.format(snap_path))
+            self.dispatch('/sbin/btrfs subvolume snapshot -r {0} {1}'.format(t.src_path,
+                                                                             snap_path),
+                          output='stderr')
+        obsolete = list()
+        self.finish(t, todo, obsolete)
+        self.delete_subvolumes(obsolete)
+        self.ui.info('Finished {0}'.format(t.task))
 
+    def received(self, t, ts, snap_path):
+        # received snapshots carry the name of the sent reference
+        if not self.ui.args.dry_run:
+            os.rename(os.path.join(t.recv_dir, os.path.basename(snap_path)),
+                      self.get_path_of_ts(t.recv_dir, t.task, ts))
+        t.parent = snap_path
+
+    def lock_refs(self, f, ref_name):
+        # a long clone run (eg. manual external backup) must not stall other runs, waiting follows --wait
+        wait = getattr(self.ui.args, 'wait', None)
+        start = time.time()
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if wait is None or wait and time.time() - start > wait:
+                    raise self.exc_class('references {0} are in use by another run, skipping clones'.format(ref_name))
+                if time.time() - start < 5:
+                    self.ui.info('Waiting for references {0}...'.format(ref_name))
+                time.sleep(5)
+
+    def do_clones(self, clones, ts_now, members):
+        # - reference snapshots on src are shared by all clone tasks of a source
+        # - receivers needing the same snapshot & parent are served by a single btrfs send
+        # - each task holds its newest reference, holds of tasks not part of this run are kept
+        #   in a state file next to the references
+        send_dir = clones[0].send_dir
+        ref_name = clones[0].ref_name
+        failed = list()
+        obsolete = list()
+        with open(os.path.join(send_dir, '.' + ref_name + '.json'), 'a+') as f:
+            # references are shared, serialize runs on the same source
+            self.lock_refs(f, ref_name)
+            f.seek(0)
+            holds = json.loads(f.read() or '{}')
+            if members:
+                holds = {k: v for k, v in holds.items() if k in members}
+
+            # resume receives from spools of failed runs before planning the next snapshot
+            for spool_path, spool in sorted(self.get_spools(ref_name).items()):
+                ts = self.get_ts_of_path(spool['snapshot'])
+                receivers = [t for t in clones if ts not in t.ts_recv_list and spool['parent'] == t.parent]
+                if receivers and os.path.exists(spool['snapshot']):
+                    self.ui.info('Resuming {0} from spool...'.format(spool['snapshot']))
+                    stats = dict()
+                    errors = self.receive_spool(spool_path, [t.recv_dir for t in receivers], stats)
+                    for t in receivers:
+                        if t.recv_dir not in errors:
+                            self.record(t.task, stats)
+                            self.received(t, ts, spool['snapshot'])
+                            t.ts_recv_list.append(ts)
+
+            # clone new timestamp
+            #   btrfs sub send <snap 0>
+            #   for n=1 to N
+            #      btrfs sub send -p <snap n-1> <snap n>
+            #    
+            #   Or, in any order,
+            #    
+            #   btrfs sub send <snap s1>
+            #   for n=1 to N
+            #      btrfs sub send -c <snap s1> -c <snap s2> -c <snap s3> ... <snap sn>
+            #    
+            #   where each subvolume that's been sent before gets added as a -c to the
+            #   next send command. This second approach means that all possible
+            #   reflinks between subvolumes can be captured, but it will send all of
+            #   the metadata across each time. The first approach may lose some manual
+            #   reflink efficiency, but is better at sending only the necessary
+            #   changed metadata.
+            # - the parent is found by lineage, there is only ever one parent per send
+            # - only the new snapshot is cloned, references of a task are always received ones
+            todo = {t.task: plan(ts_now, t.td_list, list(), t.ts_recv_list, False,
+                                 bool(t.parent) and self.unchanged(t, t.parent)) for t in clones}
+            streams = collections.defaultdict(list)
+            for t in clones:
+                if todo[t.task].snapshot:
+                    streams[t.parent].append(t)
+
+            if streams:
+                snap_path = self.get_path_of_ts(send_dir, ref_name, ts_now)
+                self.ui.info('Taking snapshot {0}...'.format(snap_path))
+                self.dispatch('/sbin/btrfs subvolume snapshot -r {0} {1}'.format(clones[0].src_path,
+                                                                                 snap_path),
+                              output='stderr')
+            for parent_path, receivers in streams.items():
+                stats = dict()
+                errors = self.send_receive(snap_path, parent_path, [t.recv_dir for t in receivers], stats)
+                for t in receivers:
+                    if t.recv_dir in errors:
+                        # planned deletions assume the new snapshot, keep everything
+                        self.ui.error('Cloning {0} to {1} failed'.format(snap_path, t.recv_dir))
+                        failed.append(t.task)
+                        del todo[t.task]
+                        continue
+                    self.received(t, ts_now, snap_path)
+                    self.record(t.task, stats)
+
+            for t in clones:
+                holds[t.task] = t.parent
+                if t.task in todo:
+                    self.finish(t, todo[t.task], obsolete)
+
+            # deleting obsolete reference snapshots on src
+            refs = set(self.get_path_of_ts(send_dir, ref_name, ts)
+                       for ts in self.get_ts(os.path.join(send_dir, ref_name + '.*')))
+            for t in clones:
+                refs.update(self.get_path_of_ts(send_dir, t.task, ts)
+                            for ts in self.get_ts(os.path.join(send_dir, t.task + '.*')))
+            # spools are kept as long as a task still holds their parent, they protect their snapshot
+            spooled = set()
+            for spool_path, spool in self.get_spools(ref_name).items():
+                if spool['parent'] in holds.values() and os.path.exists(spool['snapshot']):
+                    spooled.add(spool['snapshot'])
+                elif not self.ui.args.dry_run:
+                    self.ui.info('Removing obsolete spool: ' + spool_path)
+                    self.remove_spool(spool_path)
+            for path in sorted(refs - set(holds.values()) - spooled):
+                self.ui.info('Deleting obsolete reference: ' + path)
+                obsolete.append(path)
+
+            if not self.ui.args.dry_run:
+                f.seek(0)
+                f.truncate()
+                json.dump(holds, f, indent=4, sort_keys=True)
+            self.delete_subvolumes(obsolete)
+
+        for t in clones:
+            if t.task not in failed:
+                self.ui.info('Finished {0}'.format(t.task))
+        return failed
             
-        self.ui.info('Finished {0}'.format(task))
-            
+    def get_qgroups(self, path):
+        # referenced & exclusive bytes per subvolume id from a single listing, fails if quotas are disabled
+        def build():
+            qgroups = dict()
+            for l in self.dispatch('/sbin/btrfs qgroup show --raw ' + path,
+                                   passive=True,
+                                   output=None).stdout:
+                match = re.match(r'0/(\d+)\s+(\d+)\s+(\d+)', l.strip())
+                if match:
+                    qgroups[match.group(1)] = (int(match.group(2)), int(match.group(3)))
+            return qgroups
+        return self.cached('qgroups', path, build)
+
     def info(self, task, src_path, dest_path, opts=''):
-        pass
+        ts_now = self.get_ts_now()
+        td_list = list(self.get_td(opts, ts_now))
+        ts_list = sorted(self.get_ts(os.path.join(dest_path, task + '.*')))
+        counts = window_counts(ts_now, td_list, ts_list)
+        self.ui.info('{0}: {1} snapshots, per timedelta window {2}'.format(task,
+                                                                       len(ts_list),
+                                                                       ' '.join(str(x) for x in counts)))
+
+        # - exclusive bytes are unique to a snapshot, referenced ones include data shared with others
+        # - deleting snapshots from within the timedelta grid only shifts shared data to the neighbors,
+        #   space is freed by dropping the oldest ones. their summed exclusive bytes are a lower bound
+        # unmounted destinations (eg. unplugged external disk) are reported without sizes
+        catalog = dict()
+        qgroups = dict()
+        if not os.path.isdir(dest_path):
+            self.ui.warning('No qgroup accounting for {0}: not available'.format(dest_path))
+        else:
+            try:
+                catalog = self.get_catalog(dest_path)
+                qgroups = self.get_qgroups(dest_path)
+            except (self.exc_class, OSError) as e:
+                self.ui.warning('No qgroup accounting for {0}: {1}'.format(dest_path, e))
+        freed = 0
+        for idx, ts in enumerate(ts_list):
+            path = self.get_path_of_ts(dest_path, task, ts)
+            subvol = catalog.get(os.path.realpath(path)) if qgroups else None
+            if not subvol or str(subvol['id']) not in qgroups:
+                continue
+            rfer, excl = qgroups[str(subvol['id'])]
+            self.ui.info('{0}: referenced {1:.1f} MiB, exclusive {2:.1f} MiB'.format(path, rfer / 1024**2, excl / 1024**2))
+            if idx < info_oldest:
+                freed += excl
+                self.ui.info('{0}: dropping oldest {1} frees at least {2:.1f} MiB'.format(task, idx + 1, freed / 1024**2))
+
+        for l in summarize_history(history_file, task):
+            self.ui.info(l)
 
     def modify(self, task, src_path, dest_path, opts=''):
         pass
 
+def simulate(opts, same_fs, years=3, downtimes=((40, 1), (200, 14), (420, 3), (600, 30), (900, 2))):
+    # replay hourly runs (cron.hourly with some seconds jitter) against the planner
+    # downtimes are given as (start day, duration in days)
+    start = datetime.datetime(2020, 1, 1)
+    end = start + datetime.timedelta(days=365*years)
+    ts_send_list = list()
+    ts_recv_list = list()
+    runs = 0
+    planner_time = list()
+    curve = list()
+    ts_now = start
+    while ts_now < end:
+        day = (ts_now - start).days
+        if not any(s <= day < s + d for s, d in downtimes):
+            td_list = list(backup_btrfs.get_td(opts, ts_now))
+            t0 = time.perf_counter()
+            todo = plan(ts_now, td_list, ts_send_list, ts_recv_list, same_fs)
+            planner_time.append(time.perf_counter() - t0)
+            runs += 1
+            if todo.snapshot and not same_fs:
+                ts_send_list.append(ts_now)
+            ts_send_list = sorted(set(ts_send_list) - set(todo.delete_ref))
+            ts_recv_list = todo.keep
+        if ts_now.day == 1 and ts_now.hour == 0:
+            curve.append(len(ts_recv_list))
+        ts_now = start + datetime.timedelta(hours=(ts_now - start) // datetime.timedelta(hours=1) + 1, seconds=runs * 37 % 60)
+
+    def age(ts):
+        hours = (end - ts) // datetime.timedelta(hours=1)
+        return '{0}h'.format(hours) if hours < 48 else '{0}d'.format(hours // 24) if hours < 60*24 else '{0}m'.format(hours // 24 // 30)
+    print('{0} ({1}): {2} runs, planner {3:.1f}us/run, {4:.1f}us max'.format(opts,
+                                                                          'same fs' if same_fs else 'clone',
+                                                                          runs,
+                                                                          sum(planner_time) / runs * 1e6,
+                                                                          max(planner_time) * 1e6))
+    print('  retained ({0}): {1}'.format(len(ts_recv_list), ' '.join(age(x) for x in reversed(ts_recv_list))))
+    print('  count per month: {0}'.format(' '.join(str(x) for x in curve)))
+
 if __name__ == '__main__':
-    ## FIXME testcase
-    ## ==========================
-    #src_test_ts = [
-    #    #ts_now - datetime.timedelta(hours=10),
-    #    #ts_now - datetime.timedelta(hours=15),
-    #    #ts_now - datetime.timedelta(days=302),
-    #]
-    #src_test_paths = list(map(lambda x: self.get_path_of_ts(send_dir, task, x), src_test_ts))
-    #dest_test_ts = [
-    #    #ts_now - datetime.timedelta(minutes=30),
-    #    #ts_now - datetime.timedelta(hours=5),
-    #    #ts_now - datetime.timedelta(hours=6),
-    #    #ts_now - datetime.timedelta(hours=11),
-    #    #ts_now - datetime.timedelta(hours=12),
-    #    #ts_now - datetime.timedelta(hours=13),
-    #    #ts_now - datetime.timedelta(hours=14),
-    #    #ts_now - datetime.timedelta(hours=19),
-    #    #ts_now - datetime.timedelta(hours=20),
-    #    #ts_now - datetime.timedelta(days=20),
-    #    #ts_now - datetime.timedelta(days=40),
-    #    #ts_now - datetime.timedelta(days=200),
-    #    #ts_now - datetime.timedelta(days=300),
-    #    #ts_now - datetime.timedelta(days=400),
-    #    #ts_now - datetime.timedelta(days=401),
-    #]
-    #dest_test_paths = list(map(lambda x: self.get_path_of_ts(recv_dir, task, x), dest_test_ts))
-    ## add reference snapshots
-    #if recv_dir != send_dir:
-    #    pass
-    #    #src_test_paths.append(dest_test_paths[0].replace(recv_dir, send_dir))
-    #    #src_test_paths.append(dest_test_paths[1].replace(recv_dir, send_dir))
-    # 
-    #try:
-    #    [os.mkdir(t) for t in src_test_paths]
-    #    [os.mkdir(t) for t in dest_test_paths]
-    ## ==========================
-    #finally:
-    #    [os.rmdir(t) for t in src_test_paths]
-    #    [os.rmdir(t) for t in dest_test_paths]
-    pass
+    # - backup_btrfs.py [interval ...] simulates given intervals as clones to another fs
+    # - without arguments all configured btrfs tasks are simulated
+    if sys.argv[1:]:
+        for opts in sys.argv[1:]:
+            simulate(opts, False)
+    else:
+        import backup
+        for host_tasks in backup.tasks.values():
+            for (task, src_path, dest_path, engine, opts) in host_tasks:
+                if engine == 'btrfs':
+                    simulate(opts, os.path.dirname(src_path) == dest_path.rstrip('/'))
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+'''implement hard-linked rsync snapshot backups based on interval string
+
+NOTES
+ - for targets without btrfs (eg. ext4 or vfat usb disks), snapshots are plain directory trees <dest>/<task>.<ts>
+ - unchanged files are hard-linked to the latest snapshot (--link-dest), so they cost only a directory entry
+ - opts: interval string as for backup_btrfs (flag c is not supported), optionally followed by rsync options,
+   eg. '10d2m --exclude=/cache'
+ - retention uses the timedelta grid & planner of backup_btrfs, source and snapshots are treated as same fs
+ - snapshots are written to <dest>/.<task>.partial and renamed when complete. an interrupted run leaves the
+   partial tree behind, the next run continues from it
+ - vfat/exfat support neither hard links nor ownership. there the latest snapshot is renamed to the partial tree
+   and updated in place, so a single mirror is kept instead of full copies per snapshot. modification times
+   are compared with 2s tolerance
+ - transferred bytes per run are recorded in the history file, summarized by info()
+'''
+import glob
+import os
+import pylon.base
+import re
+import sys
+import time
+from backup_btrfs import backup_btrfs, plan, get_mount, window_counts, append_history, summarize_history
+
+history_file = 'rsync_history.jsonl'
+
+# filesystems without hard links & unix permissions
+plain_fs = ('vfat', 'exfat', 'msdos')
+
+def parse_stats(lines):
+    # - transferred bytes & regular files from rsync --stats output lines, linked files are not counted
+    # - check against a real run with: rsync -a --stats <src>/ <dest>/ | backup_rsync.py
+    output = os.linesep.join(lines or [])
+    def stat(name):
+        match = re.search(name + r': ([0-9,]+)', output)
+        return int(match.group(1).replace(',', '')) if match else 0
+    return {'bytes': stat('Total transferred file size'),
+            'files': stat('Number of regular files transferred')}
+
+class backup_rsync(pylon.base.base):
+    __doc__ = sys.modules[__name__].__doc__
+
+    def get_ts(self, task, dest_path):
+        ts_list = list()
+        for d in glob.glob(os.path.join(dest_path, task + '.*')):
+            try:
+                ts_list.append(backup_btrfs.get_ts_of_path(d))
+            except Exception:
+                self.ui.warning('Failed to extract ts: ' + d)
+        return sorted(ts_list)
+
+    def do(self, task, src_path, dest_path, opts=''):
+        self.ui.info('Processing {0}...'.format(task))
+        (interval, _, rsync_opts) = opts.partition(' ')
+        if not os.path.isdir(dest_path):
+            raise self.exc_class('destination {0} is not available'.format(dest_path))
+
+        ts_now = backup_btrfs.get_ts_now()
+        td_list = list(backup_btrfs.get_td(interval, ts_now))
+        ts_list = self.get_ts(task, dest_path)
+        todo = plan(ts_now, td_list, ts_list, ts_list, True)
+
+        moved = None
+        if todo.snapshot:
+            snap_path = backup_btrfs.get_path_of_ts(dest_path, task, ts_now)
+            partial_path = os.path.join(dest_path, '.' + task + '.partial')
+            plain = get_mount(dest_path).fstype in plain_fs
+            if os.path.exists(partial_path):
+                self.ui.warning('Continuing interrupted snapshot: ' + partial_path)
+            elif plain and ts_list:
+                moved = ts_list[-1]
+                latest = backup_btrfs.get_path_of_ts(dest_path, task, moved)
+                self.ui.info('Updating {0} in place...'.format(latest))
+                if not self.ui.args.dry_run:
+                    os.rename(latest, partial_path)
+
+            # - archive mode incl. hard links, acls & xattrs, link unchanged files to the latest snapshot
+            # - plain filesystems only keep contents & modtimes
+            if plain:
+                cmd = '/usr/bin/rsync -rt --modify-window=2 '
+            else:
+                cmd = '/usr/bin/rsync -aHAX --numeric-ids '
+                if ts_list:
+                    cmd += '--link-dest={0} '.format(backup_btrfs.get_path_of_ts(dest_path, task, ts_list[-1]))
+            cmd += '--delete --stats {0} {1}/ {2}/'.format(rsync_opts, src_path.rstrip('/'), partial_path)
+
+            self.ui.info('Taking snapshot {0}...'.format(snap_path))
+            start = time.time()
+            try:
+                output = self.dispatch(cmd,
+                                       output=None).stdout
+            except self.exc_class as e:
+                # files vanished during transfer are common for live sources
+                if e.owner.ret_val != 24:
+                    raise e
+                self.ui.warning('Some files vanished during transfer!')
+                output = e.owner.stdout
+            if not self.ui.args.dry_run:
+                os.rename(partial_path, snap_path)
+
+                stats = parse_stats(output)
+                stats['seconds'] = time.time() - start
+                self.ui.info('Transferred {0:.1f} MiB in {1} files, {2:.0f}s'.format(stats['bytes'] / 1024**2,
+                                                                                   stats['files'],
+                                                                                   stats['seconds']))
+                append_history(history_file, task, ts_now, {'bytes': stats['bytes'],
+                                                             'files': stats['files'],
+                                                             'seconds': round(stats['seconds'], 1)})
+
+        # - hard-linked trees are deleted as a whole, shared files stay with the remaining snapshots
+        # - a mirror updated in place has become the new snapshot
+        obsolete = list()
+        for ts in (x for x in todo.delete if x != moved):
+            path = backup_btrfs.get_path_of_ts(dest_path, task, ts)
+            self.ui.info('Deleting snapshot: ' + path)
+            obsolete.append(path)
+        for ts in (x for x in todo.keep if x != moved):
+            self.ui.debug('Keeping snapshot: ' + backup_btrfs.get_path_of_ts(dest_path, task, ts))
+        if obsolete:
+            self.dispatch('/bin/rm -rf ' + ' '.join(obsolete),
+                          output='stderr')
+        self.ui.info('Finished {0}'.format(task))
+
+    def info(self, task, src_path, dest_path, opts=''):
+        interval = opts.partition(' ')[0]
+        ts_now = backup_btrfs.get_ts_now()
+        td_list = list(backup_btrfs.get_td(interval, ts_now))
+        ts_list = self.get_ts(task, dest_path)
+        counts = window_counts(ts_now, td_list, ts_list)
+        self.ui.info('{0}: {1} snapshots, per timedelta window {2}'.format(task,
+                                                                       len(ts_list),
+                                                                       ' '.join(str(x) for x in counts)))
+        for l in summarize_history(history_file, task):
+            self.ui.info(l)
+
+    def modify(self, task, src_path, dest_path, opts=''):
+        pass
+
+if __name__ == '__main__':
+    # parse rsync --stats output from stdin, see parse_stats
+    print(parse_stats(sys.stdin.read().splitlines()))
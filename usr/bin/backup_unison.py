@@ -1,34 +1,251 @@
+import fnmatch
+import os
 import pylon.base as base
+import queue
+import re
+import select
+import shlex
+import shutil
+import subprocess
+import threading
+import time
 
-class backup_unison(base.base):
-    'implement semi-automated unison synchronization'
+# eselect unison update is needed once per process
+eselect_lock = threading.Lock()
+eselect_done = False
 
-    def do(self, task, src_path, dest_path, opts=''):
-        self.ui.info('Synchronizing {0} to {1}...'.format(src_path, dest_path))
-        try:
-            self.dispatch('eselect unison update && unison ' +
+# watch mode without unison-fsmonitor
+# - changes are synchronized after watch_settle seconds without further events, at the latest after watch_latency
+# - more changed subtrees than watch_paths trigger a full scan
+watch_settle = 5
+watch_latency = 60
+watch_paths = 100
+
+def subtrees(roots, changed):
+    # - parent directories of changed paths relative to their root, nested ones are covered by their ancestors
+    # - None if a root itself changed, needs a full scan
+    rel = set()
+    for path in changed:
+        for root in roots:
+            root = root.rstrip('/') + '/'
+            if path.startswith(root):
+                rel.add(os.path.dirname(path[len(root):].rstrip('/')))
+                break
+    if '' in rel:
+        return None
+    kept = set()
+    for path in sorted(rel, key=lambda x: x.count('/')):
+        parts = path.split('/')
+        if not any('/'.join(parts[:idx]) in kept for idx in range(1, len(parts))):
+            kept.add(path)
+    return sorted(kept)
 
-                          # paths
-                          src_path + ' ' + dest_path + ' '
+# large shares are split into their top-level subdirectories via '-split <jobs>' in the task opts
+# - every subdirectory existing on both sides is an independent pair of roots with its own archive
+# - remaining top-level entries (files, dirs on one side only) are synchronized via -path on the task roots
+split_regex = r'-split\s+([0-9]+)'
+split_summary = r'\(([0-9]+) items? transferred, ([0-9]+) skipped, ([0-9]+) failed\)'
+split_item = r'^\s*(skipped|failed): (.*)$'
 
-                          # avoid verbose startup
-                          '-contactquietly ' +
+def subtree_opts(tokens, sub):
+    # - Path & BelowPath patterns of -ignore/-ignorenot are rebased onto the subdirectory, others are dropped
+    # - Name & Regex patterns are kept as they are, regexes spanning the top-level directory do not match anymore
+    # - None if the subdirectory itself is ignored
+    kept = list()
+    tokens = iter(tokens)
+    for token in tokens:
+        if token not in ('-ignore', '-ignorenot'):
+            kept.append(token)
+            continue
+        pattern = next(tokens, '')
+        (kind, _, path) = pattern.partition(' ')
+        if kind not in ('Path', 'BelowPath'):
+            kept += [token, pattern]
+            continue
+        (top, _, rest) = path.strip().partition('/')
+        if not fnmatch.fnmatchcase(sub, top):
+            continue
+        if rest:
+            kept += [token, kind + ' ' + rest]
+        elif token == '-ignore':
+            return None
+    return kept
 
-                          # synchronize modtimes, owner & group properties
-                          '-times -owner -group ' +
+class backup_unison(base.base):
+    'implement semi-automated unison synchronization'
 
-                          # be quiet
-                          '-terse ' +
+    def eselect(self):
+        global eselect_done
+        with eselect_lock:
+            if not eselect_done:
+                self.dispatch('eselect unison update',
+                              output='stderr')
+                eselect_done = True
 
-                          # add additional options
-                          opts,
-                          output='both')
+    def sync(self, cmd, output='both'):
+        try:
+            self.dispatch(cmd,
+                          output=output)
         except self.exc_class as e:
             if e.owner.ret_val == 1:
                 self.ui.warning('Some files were skipped, maybe conflicts occured!')
             else:
                 raise e
 
+    def command(self, src_path, dest_path, opts):
+        return ('unison ' +
+
+                # paths
+                src_path + ' ' + dest_path + ' '
+
+                # avoid verbose startup
+                '-contactquietly ' +
+
+                # synchronize modtimes, owner & group properties
+                '-times -owner -group ' +
+
+                # be quiet
+                '-terse ' +
+
+                # add additional options
+                opts)
+
+    def do(self, task, src_path, dest_path, opts=''):
+        self.eselect()
+        match = re.search(split_regex, opts)
+        opts = re.sub(split_regex, '', opts)
+        if match and not getattr(self.ui.args, 'repeat', False):
+            self.split(task, src_path, dest_path, opts, int(match.group(1)))
+            return
+        if match:
+            self.ui.warning('Watch mode synchronizes {0} as a whole, -split is ignored'.format(task))
+        cmd = self.command(src_path, dest_path, opts)
+
+        if not getattr(self.ui.args, 'repeat', False):
+            self.ui.info('Synchronizing {0} to {1}...'.format(src_path, dest_path))
+            self.sync(cmd)
+            return
+
+        # persistent mode, only changed subtrees are rescanned
+        # - unison-fsmonitor reports changes to unison itself
+        # - otherwise inotify events of both roots are fed to unison as -path arguments
+        if shutil.which('unison-fsmonitor'):
+            self.ui.info('Watching {0} & {1} via unison-fsmonitor...'.format(src_path, dest_path))
+            self.sync(cmd + ' -repeat watch', output='nopipes')
+            return
+        self.ui.info('Synchronizing {0} to {1}...'.format(src_path, dest_path))
+        self.sync(cmd)
+        if self.ui.args.dry_run:
+            return
+        self.watch(task, (src_path, dest_path), cmd)
+
+    def watch(self, task, roots, cmd):
+        self.ui.info('Watching {0} via inotify...'.format(' & '.join(roots)))
+        proc = subprocess.Popen(['/usr/bin/inotifywait', '-m', '-r', '-q',
+                                 '-e', 'modify,attrib,close_write,create,delete,move',
+                                 '--exclude', r'(^|/)\.unison\.',
+                                 '--format', '%w%f'] + list(roots),
+                                stdout=subprocess.PIPE)
+        try:
+            fd = proc.stdout.fileno()
+            buf = b''
+            changed = set()
+            since = None
+            while True:
+                timeout = max(0, min(watch_settle, since + watch_latency - time.time())) if changed else None
+                if select.select([fd], [], [], timeout)[0]:
+                    data = os.read(fd, 65536)
+                    if not data:
+                        raise self.exc_class('inotifywait terminated for ' + task)
+                    *lines, buf = (buf + data).split(b'\n')
+                    if lines and not changed:
+                        since = time.time()
+                    changed.update(os.fsdecode(x) for x in lines)
+                    if timeout != 0:
+                        continue
+
+                paths = subtrees(roots, changed)
+                changed = set()
+                if paths is None or len(paths) > watch_paths:
+                    self.ui.info('Synchronizing {0}...'.format(task))
+                    self.sync(cmd)
+                else:
+                    self.ui.info('Synchronizing {0}: {1}'.format(task, ' '.join(paths)))
+                    self.sync(cmd + ''.join(' -path ' + shlex.quote(x) for x in paths))
+        finally:
+            proc.kill()
+            proc.wait()
+
+    def split(self, task, src_path, dest_path, opts, jobs):
+        if any('://' in x for x in (src_path, dest_path)):
+            self.ui.warning('Remote roots cannot be split, synchronizing {0} as a whole'.format(task))
+            self.ui.info('Synchronizing {0} to {1}...'.format(src_path, dest_path))
+            self.sync(self.command(src_path, dest_path, opts))
+            return
+
+        # parallel runs cannot ask questions
+        tokens = shlex.split(opts)
+        if '-batch' not in tokens:
+            tokens.append('-batch')
+        (src, dest) = ({x.name: x.is_dir(follow_symlinks=False) for x in os.scandir(path)}
+                       for path in (src_path, dest_path))
+        dirs = sorted(x for x in src if src[x] and dest.get(x))
+        pending = queue.Queue()
+        for sub in dirs:
+            sub_tokens = subtree_opts(tokens, sub)
+            if sub_tokens is not None:
+                pending.put((sub, self.command(os.path.join(src_path, sub),
+                                               os.path.join(dest_path, sub),
+                                               ' '.join(shlex.quote(x) for x in sub_tokens))))
+        paths = sorted((set(src) | set(dest)) - set(dirs))
+        if paths:
+            pending.put(('', self.command(src_path, dest_path,
+                                          ' '.join(shlex.quote(x) for x in tokens + [y for x in paths for y in ('-path', x)]))))
+        roots = pending.qsize()
+
+        # bounded number of workers taking roots from the queue, results are merged afterwards
+        results = dict()
+        def worker():
+            while True:
+                try:
+                    (sub, cmd) = pending.get_nowait()
+                except queue.Empty:
+                    return
+                self.ui.debug('Synchronizing {0}: {1}'.format(task, sub or 'top-level entries'))
+                try:
+                    results[sub] = (0, self.dispatch(cmd,
+                                                     output=None).stdout)
+                except self.exc_class as e:
+                    results[sub] = (e.owner.ret_val, e.owner.stdout)
+
+        self.ui.info('Synchronizing {0} to {1} as {2} roots, {3} jobs...'.format(src_path, dest_path, roots, jobs))
+        for _ in range(min(jobs, roots)):
+            self.dispatch(worker,
+                          blocking=False)
+        self.join()
+
+        # - unison exit codes: 1 skipped, 2 non-fatal failures, 3 fatal error
+        # - reported items are relative to the roots of the run
+        totals = [0, 0, 0]
+        items = list()
+        fatal = list()
+        for sub, (ret_val, output) in sorted(results.items()):
+            output = os.linesep.join(output or [])
+            for match in re.finditer(split_summary, output):
+                totals = [x + int(y) for x, y in zip(totals, match.groups())]
+            for match in re.finditer(split_item, output, re.MULTILINE):
+                items.append('{0}: {1}'.format(match.group(1), os.path.join(sub, match.group(2))))
+            if ret_val >= 3:
+                fatal.append(sub or 'top-level entries')
+                self.ui.error('Synchronizing {0} failed:\n{1}'.format(os.path.join(src_path, sub), output.strip()))
+        self.ui.info('{0}: {1} items transferred, {2} skipped, {3} failed'.format(task, *totals))
+        for x in items:
+            self.ui.warning(x)
+        if fatal:
+            raise self.exc_class('failed unison roots of {0}: {1}'.format(task, ', '.join(fatal)))
+        if totals[1]:
+            self.ui.warning('Some files were skipped, maybe conflicts occured!')
+
     def info(self, task, src_path, dest_path, opts=''):
         # unison itself does not allow to see differences all at once via the
         # console interface. if a sync is not successful, two backups